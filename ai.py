@@ -1,21 +1,151 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing as mp
 import numpy as np
+import time
 
+import bitboard
 from othello import Board
-from value import ScorerWrapper, CountScorer
+from value import ScorerWrapper
+from endgame import EndgameSolver
 
 import sys
 
+class TranspositionTable(object):
+    """Fixed size, zobrist keyed table of search results.
+
+    https://www.chessprogramming.org/Transposition_Table
+
+    Values are kept from black's point of view, so one table can be
+    shared by the black and the white `Bot` of a game as long as both
+    use the same evaluator. The values are only valid for the weights
+    the evaluator had when they were stored: call `invalidate` whenever
+    the weights change.
+
+    Entries are immutable tuples written with a single assignment and
+    checked against their key when read, so searches in several threads
+    can share a table without locking. A lost store only costs a
+    re-search, but the hit and miss counts are then not exact.
+    """
+    EXACT = 0
+    LOWER = 1
+    UPPER = 2
+    WHITE_TO_MOVE = 0x9e3779b97f4a7c15
+
+    def __init__(self, size=1<<20):
+        self._size = size
+        self._entries = [None] * size
+        self._age = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def clear(self):
+        self._entries = [None] * self._size
+        self._age = 0
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        self._age += 1
+
+    def invalidate(self):
+        """Drops every entry without clearing the table, for when the
+        evaluator changes.
+        """
+        self._generation += 1
+
+    def key(self, board, player):
+        if player == Board.WHITE:
+            return board.hash ^ TranspositionTable.WHITE_TO_MOVE
+        else:
+            return board.hash
+
+    def probe(self, key):
+        """Returns (value, depth, flag, move) or None.
+        """
+        e = self._entries[key % self._size]
+        if e is not None and e[0] == key and e[6] == self._generation:
+            self.hits += 1
+            return e[1:5]
+        self.misses += 1
+        return None
+
+    def store(self, key, value, depth, flag, move):
+        """Depth preferred replacement, entries left over from earlier
+        searches are always replaced.
+        """
+        idx = key % self._size
+        e = self._entries[idx]
+        if (e is None or e[0] == key or e[5] != self._age or e[6] != self._generation
+            or depth >= e[2]):
+            self._entries[idx] = (key, value, depth, flag, move, self._age, self._generation)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# static move ordering, corners first and x-squares last
+_SQUARE_ORDER = [
+    100, -20, 10,  5,  5, 10, -20, 100,
+    -20, -50, -2, -2, -2, -2, -50, -20,
+     10,  -2,  1,  1,  1,  1,  -2,  10,
+      5,  -2,  1,  0,  0,  1,  -2,   5,
+      5,  -2,  1,  0,  0,  1,  -2,   5,
+     10,  -2,  1,  1,  1,  1,  -2,  10,
+    -20, -50, -2, -2, -2, -2, -50, -20,
+    100, -20, 10,  5,  5, 10, -20, 100,
+]
+
+
 class AlphaBeta(object):
     MAX_VAL = float("inf")
     MIN_VAL = float("-inf")
-    def __init__(self, evaluator, depth):
+    # remaining depth from which children are ordered by opponent mobility
+    MOBILITY_DEPTH = 3
+    # cutoffs are counted by the index of the move causing them, the last
+    # count covers this index and later ones
+    CUTOFF_INDICES = 8
+    def __init__(self, evaluator, depth, table=None, time_limit=None, batch=False):
         """https://en.wikipedia.org/wiki/Alpha-beta_pruning
         http://web.cs.ucla.edu/~rosen/161/notes/alphabeta.html
+
+        With `time_limit` (seconds per move) the search deepens
+        iteratively up to `depth` (or to the end of the game if `depth`
+        is None) and returns the deepest completed result.
+
+        With `batch` the children of a depth 1 node are made on
+        bitboards and scored with one `evaluate_many` call of the
+        evaluator. The node then takes the best child's value instead of
+        stopping at the first cutoff, a bound at least as tight, so the
+        value of the search is the same.
+
+        With `profile` set the time spent in the evaluator is measured,
+        which costs two clock reads per evaluation.
         """
         self._evaluator = evaluator
         self._depth = depth
+        self._table = table
+        self._time_limit = time_limit
+        self._batch = batch
+        self._sign = 1
+        self._root_depth = depth
+        self._deadline = None
+        self._nodes = 0
+        self._next_check = 0
+        self._killers = {}
+        self._history = {Board.BLACK: [0] * 64, Board.WHITE: [0] * 64}
+        self.depth_reached = 0
+        self._leaves = 0
+        self._eval_time = 0.0
+        self._cutoff_index = [0] * AlphaBeta.CUTOFF_INDICES
+        self.profile = False
+        self.stats = {}
 
     @property
     def depth(self):
@@ -25,17 +155,217 @@ class AlphaBeta(object):
     def depth(self, val):
         self._depth = val
 
+    @property
+    def time_limit(self):
+        return self._time_limit
+
+    @time_limit.setter
+    def time_limit(self, val):
+        self._time_limit = val
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def nodes(self):
+        """Nodes searched since the searcher was made or its counters
+        reset.
+        """
+        return self._nodes
+
+    @property
+    def leaves(self):
+        return self._leaves
+
+    def reset_counters(self):
+        self._nodes = 0
+        self._leaves = 0
+
+    def close(self):
+        pass
+
     def search(self, board, player):
-        alpha = AlphaBeta.MIN_VAL
-        beta = AlphaBeta.MAX_VAL
+        """Returns (value, move), `stats` then describes the search:
+        nodes, leaves, cutoffs by the index of the move causing them,
+        transposition table hits and misses, time spent in total (and in
+        the evaluator with `profile`), and the depth reached.
+        """
+        nodes = self._nodes
+        if self._table is not None:
+            hits, misses = self._table.hits, self._table.misses
+        self._leaves = 0
+        self._eval_time = 0.0
+        self._cutoff_index = [0] * AlphaBeta.CUTOFF_INDICES
+        start = time.time()
+        try:
+            return self._deepen(board, player)
+        finally:
+            self.stats = { "nodes": self._nodes - nodes,
+                           "leaves": self._leaves,
+                           "cutoffs": self._cutoff_index,
+                           "seconds": time.time() - start,
+                           "depth": self.depth_reached }
+            if self.profile:
+                self.stats["evaluator_seconds"] = self._eval_time
+            if self._table is not None:
+                self.stats["table_hits"] = self._table.hits - hits
+                self.stats["table_misses"] = self._table.misses - misses
+
+    def _deepen(self, board, player):
+        if self._table is not None:
+            self._table.new_search()
+        # values are from the point of view of the player at the root
+        if player == Board.BLACK:
+            self._sign = 1
+        else:
+            self._sign = -1
+        self._killers = {}
+        for h in self._history.values():
+            for k in range(64):
+                h[k] >>= 1
+
+        if self._time_limit is None:
+            self.depth_reached = self._depth
+            return self._search(board, player, self._depth)
+
+        max_depth = board.blanks
+        if self._depth is not None:
+            max_depth = min(self._depth, max_depth)
+        deadline = time.time() + self._time_limit
+        r = self._search(board, player, 1)
+        self.depth_reached = 1
+        self._deadline = deadline
+        self._next_check = self._nodes + 256
+        try:
+            for d in range(2, max_depth+1):
+                r = self._search(board, player, d)
+                self.depth_reached = d
+        except SearchTimeout:
+            pass
+        finally:
+            self._deadline = None
+        return r
+
+    def _search(self, board, player, depth):
+        self._root_depth = depth
         return self._alpha_beta_search(board, player,
-                                       alpha, beta,
-                                       self._depth, True)
+                                       AlphaBeta.MIN_VAL, AlphaBeta.MAX_VAL,
+                                       depth, True)
+
+    def search_move(self, board, player, move, depth, alpha, deadline=None):
+        """Value for `player` of playing `move` on `board`, searched to
+        `depth` with the window (alpha, inf): exact if above alpha, an
+        upper bound otherwise. Raises SearchTimeout after `deadline`.
+        """
+        if player == Board.BLACK:
+            self._sign = 1
+        else:
+            self._sign = -1
+        self._root_depth = depth
+        self._deadline = deadline
+        self._next_check = self._nodes + 256
+        board.flip(move[0], move[1], player)
+        try:
+            v, _ = self._alpha_beta_search(board, Board.opponent(player),
+                                           alpha, AlphaBeta.MAX_VAL,
+                                           depth-1, False)
+        finally:
+            board.undo()
+            self._deadline = None
+        return v
+
+    def _probe(self, key, depth, alpha, beta):
+        """Returns (alpha, beta, value, move), value is None unless the
+        stored entry decides this node.
+        """
+        entry = self._table.probe(key)
+        if entry is None:
+            return alpha, beta, None, None
+        value, d, flag, move = entry
+        if d < depth or depth == self._root_depth:
+            return alpha, beta, None, move
+        value *= self._sign
+        if self._sign < 0 and flag != TranspositionTable.EXACT:
+            flag = TranspositionTable.LOWER + TranspositionTable.UPPER - flag
+        if flag == TranspositionTable.EXACT:
+            return alpha, beta, value, move
+        elif flag == TranspositionTable.LOWER:
+            alpha = max(alpha, value)
+        else:
+            beta = min(beta, value)
+        if alpha >= beta:
+            return alpha, beta, value, move
+        return alpha, beta, None, move
+
+    def _store(self, key, r, depth, alpha, beta, act):
+        if r <= alpha:
+            flag = TranspositionTable.UPPER
+        elif r >= beta:
+            flag = TranspositionTable.LOWER
+        else:
+            flag = TranspositionTable.EXACT
+        if self._sign < 0 and flag != TranspositionTable.EXACT:
+            flag = TranspositionTable.LOWER + TranspositionTable.UPPER - flag
+        self._table.store(key, r * self._sign, depth, flag, act)
+
+    def _order(self, board, player, actions, best, depth):
+        """Hash (or previous iteration) move, killers, then history,
+        opponent mobility and square values.
+        """
+        if len(actions) < 2:
+            return actions
+        killers = self._killers.get(depth, ())
+        history = self._history[player]
+        opponent = Board.opponent(player)
+        p, o = board.bits
+        if player == Board.WHITE:
+            p, o = o, p
+        keys = {}
+        for a in actions:
+            sq = a[0] * 8 + a[1]
+            if a == best:
+                k = 1 << 40
+            elif a in killers:
+                k = 1 << 30
+            else:
+                k = history[sq] + _SQUARE_ORDER[sq]
+                if depth >= AlphaBeta.MOBILITY_DEPTH:
+                    f = bitboard.flip_mask(sq, p, o)
+                    k -= 16 * bitboard.popcount(bitboard.moves_mask(o ^ f, p | f | (1 << sq)))
+            keys[a] = k
+        return sorted(actions, key=keys.get, reverse=True)
+
+    def _cutoff(self, player, act, depth, index=None):
+        if index is not None:
+            self._cutoff_index[min(index, AlphaBeta.CUTOFF_INDICES - 1)] += 1
+        killers = self._killers.setdefault(depth, [])
+        if act not in killers:
+            killers.insert(0, act)
+            del killers[2:]
+        self._history[player][act[0] * 8 + act[1]] += depth * depth
 
     def _alpha_beta_search(self, board, player, alpha, beta, depth, is_maximizing_player):
+        self._nodes += 1
+        if self._deadline is not None and self._nodes >= self._next_check:
+            self._next_check = self._nodes + 256
+            if time.time() > self._deadline:
+                raise SearchTimeout()
+
         if board.is_terminal_state() or depth == 0:
+            self._leaves += 1
+            if self.profile:
+                return self._timed_evaluation(board), None
             return self._evaluator(board), None
 
+        best = None
+        if self._table is not None:
+            key = self._table.key(board, player)
+            alpha, beta, v, best = self._probe(key, depth, alpha, beta)
+            if v is not None:
+                return v, best
+            alpha0, beta0 = alpha, beta
+
         act = None
         if is_maximizing_player:
             r = AlphaBeta.MIN_VAL
@@ -44,12 +374,25 @@ class AlphaBeta(object):
 
         actions = board.feasible_pos(player)
         opponent = Board.opponent(player)
-        if len(actions) > 0:
-            for i,j in actions:
-                with board.flip2(i, j, player):
+        if self._batch and depth == 1 and len(actions) > 0:
+            r, act = self._frontier(board, player, actions, is_maximizing_player)
+            if is_maximizing_player:
+                alpha = max(r, alpha)
+            else:
+                beta = min(r, beta)
+            # the children are not ordered, so the cutoff is not counted
+            # by move index
+            if alpha >= beta:
+                self._cutoff(player, act, depth)
+        elif len(actions) > 0:
+            for k, (i, j) in enumerate(self._order(board, player, actions, best, depth)):
+                board.flip(i, j, player)
+                try:
                     v, _ = self._alpha_beta_search(board, opponent,
                                                    alpha, beta,
                                                    depth-1, not is_maximizing_player)
+                finally:
+                    board.undo()
                 if is_maximizing_player:
                     if r < v:
                         act = (i, j)
@@ -62,11 +405,273 @@ class AlphaBeta(object):
                     r = min(r, v)
 
                 if alpha >= beta:
+                    self._cutoff(player, (i, j), depth, k)
                     break
         else:
             r, _ = self._alpha_beta_search(board, opponent,
                                            alpha, beta,
                                            depth, not is_maximizing_player)
+        if self._table is not None:
+            self._store(key, r, depth, alpha0, beta0, act)
+        return r, act
+
+    def _timed_evaluation(self, board):
+        start = time.time()
+        v = self._evaluator(board)
+        self._eval_time += time.time() - start
+        return v
+
+    def _frontier(self, board, player, actions, is_maximizing_player):
+        """Value and move of a depth 1 node from one batched evaluation
+        of its children, ties go to the earlier move in `actions`.
+        """
+        p, o = board.bits
+        if player == Board.WHITE:
+            p, o = o, p
+        n = len(actions)
+        mine, theirs = [], []
+        for i, j in actions:
+            sq = i * 8 + j
+            f = bitboard.flip_mask(sq, p, o)
+            mine.append(p | f | (1 << sq))
+            theirs.append(o ^ f)
+        mine = np.array(mine, dtype=np.uint64)
+        theirs = np.array(theirs, dtype=np.uint64)
+        self._nodes += n
+        self._leaves += n
+        if player == Board.BLACK:
+            cells = bitboard.to_array(mine, theirs)
+        else:
+            cells = bitboard.to_array(theirs, mine)
+        if self.profile:
+            start = time.time()
+            values = self._evaluator.evaluate_many(cells)
+            self._eval_time += time.time() - start
+        else:
+            values = self._evaluator.evaluate_many(cells)
+        if is_maximizing_player:
+            k = int(np.argmax(values))
+        else:
+            k = int(np.argmin(values))
+        return float(values[k]), actions[k]
+
+class PrincipalVariation(AlphaBeta):
+    """Negamax principal variation search with aspiration windows.
+
+    https://www.chessprogramming.org/Principal_Variation_Search
+    https://www.chessprogramming.org/Aspiration_Windows
+
+    The first (best ordered) child gets the full window, the others a
+    null window just above alpha and are re-searched if they beat it.
+    Evaluations are real valued, so the null window is (alpha, next
+    float above alpha). The root is searched within ASPIRATION of the
+    previous result first and with the full window if that fails. The
+    value is the same as `AlphaBeta`'s at the same depth.
+    """
+    ASPIRATION = 4.0
+
+    def __init__(self, evaluator, depth, table=None, time_limit=None, batch=False):
+        super(PrincipalVariation, self).__init__(evaluator, depth, table, time_limit, batch)
+        self._guess = None
+        self.researches = 0
+
+    def search(self, board, player):
+        self._guess = None
+        return super(PrincipalVariation, self).search(board, player)
+
+    def _search(self, board, player, depth):
+        self._root_depth = depth
+        if self._guess is not None:
+            alpha = self._guess - PrincipalVariation.ASPIRATION
+            beta = self._guess + PrincipalVariation.ASPIRATION
+            r, act = self._pvs(board, player, alpha, beta, depth, 1)
+            if alpha < r < beta:
+                self._guess = r
+                return r, act
+            self.researches += 1
+        r, act = self._pvs(board, player, AlphaBeta.MIN_VAL, AlphaBeta.MAX_VAL, depth, 1)
+        self._guess = r
+        return r, act
+
+    def _pvs(self, board, player, alpha, beta, depth, color):
+        """Value for `player`, `color` is 1 if `player` is at the root
+        and -1 otherwise.
+        """
+        self._nodes += 1
+        if self._deadline is not None and self._nodes >= self._next_check:
+            self._next_check = self._nodes + 256
+            if time.time() > self._deadline:
+                raise SearchTimeout()
+
+        if board.is_terminal_state() or depth == 0:
+            self._leaves += 1
+            if self.profile:
+                return color * self._timed_evaluation(board), None
+            return color * self._evaluator(board), None
+
+        best = None
+        if self._table is not None:
+            # the table works with the window of the root player
+            key = self._table.key(board, player)
+            if color > 0:
+                alpha0, beta0 = alpha, beta
+            else:
+                alpha0, beta0 = -beta, -alpha
+            ra, rb, v, best = self._probe(key, depth, alpha0, beta0)
+            if v is not None:
+                return color * v, best
+            if color > 0:
+                alpha, beta = ra, rb
+            else:
+                alpha, beta = -rb, -ra
+            # the result is a bound on the window searched
+            alpha0, beta0 = ra, rb
+
+        act = None
+        r = AlphaBeta.MIN_VAL
+        actions = board.feasible_pos(player)
+        opponent = Board.opponent(player)
+        if self._batch and depth == 1 and len(actions) > 0:
+            r, act = self._frontier(board, player, actions, color > 0)
+            r *= color
+            if r >= beta:
+                self._cutoff(player, act, depth)
+        elif len(actions) > 0:
+            for k, (i, j) in enumerate(self._order(board, player, actions, best, depth)):
+                board.flip(i, j, player)
+                try:
+                    if k == 0:
+                        v, _ = self._pvs(board, opponent, -beta, -alpha, depth-1, -color)
+                        v = -v
+                    else:
+                        scout = np.nextafter(alpha, AlphaBeta.MAX_VAL)
+                        v, _ = self._pvs(board, opponent, -scout, -alpha, depth-1, -color)
+                        v = -v
+                        if alpha < v < beta:
+                            self.researches += 1
+                            v, _ = self._pvs(board, opponent, -beta, -v, depth-1, -color)
+                            v = -v
+                finally:
+                    board.undo()
+                if v > r:
+                    r, act = v, (i, j)
+                alpha = max(alpha, v)
+                if alpha >= beta:
+                    self._cutoff(player, (i, j), depth, k)
+                    break
+        else:
+            r, _ = self._pvs(board, opponent, -beta, -alpha, depth, -color)
+            r = -r
+        if self._table is not None:
+            self._store(key, color * r, depth, alpha0, beta0, act)
+        return r, act
+
+_split_worker = None
+# the root search the worker's table was last aged for
+_split_generation = None
+
+def _init_split_worker(evaluator, table_size, batch):
+    global _split_worker
+    table = TranspositionTable(table_size) if table_size else None
+    _split_worker = (AlphaBeta(evaluator, None, table, batch=batch), Board())
+
+def _search_split(task):
+    """Searches a root move with the window (alpha, inf), returns the
+    value (None on timeout) and the numbers of nodes and leaves.
+    """
+    global _split_generation
+    black, white, player, move, depth, alpha, generation, deadline = task
+    searcher, board = _split_worker
+    if searcher.table is not None and generation != _split_generation:
+        searcher.table.new_search()
+        _split_generation = generation
+    board.set_bits(black, white)
+    searcher.reset_counters()
+    try:
+        v = searcher.search_move(board, player, move, depth, alpha, deadline)
+    except SearchTimeout:
+        v = None
+    return v, searcher.nodes, searcher.leaves
+
+class ParallelAlphaBeta(AlphaBeta):
+    """Root splitting over `workers` processes: the first root move (by
+    the usual ordering) is searched here with the full window, the others
+    are then searched by the workers with the window (value of the first
+    move, inf). A move searched that way returns its exact value when it
+    is better, a bound otherwise, so the root value is the same as the
+    serial search's.
+
+    Each worker has its own transposition table of `table_size` entries,
+    aged once per root search, and a copy of the evaluator as it was when
+    the pool started. Within a process that can't have children (e.g. a
+    pool worker) the search is serial. `close` stops the workers.
+    """
+    def __init__(self, evaluator, depth, table=None, time_limit=None, batch=False,
+                 workers=2, table_size=1<<18):
+        super(ParallelAlphaBeta, self).__init__(evaluator, depth, table, time_limit, batch)
+        self._workers = workers
+        self._table_size = table_size
+        self._pool = None
+        self._generation = 0
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def start(self):
+        """Starts the workers, otherwise the first search that splits
+        does. Returns their pool, None if the search is serial.
+        """
+        if self._pool is None and not mp.current_process().daemon:
+            self._pool = mp.Pool(self._workers, initializer=_init_split_worker,
+                                 initargs=(self._evaluator, self._table_size, self._batch))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def search(self, board, player):
+        self._generation += 1
+        return super(ParallelAlphaBeta, self).search(board, player)
+
+    def _search(self, board, player, depth):
+        actions = board.feasible_pos(player)
+        if depth < 2 or len(actions) < 2 or self.start() is None:
+            return super(ParallelAlphaBeta, self)._search(board, player, depth)
+        self._root_depth = depth
+        self._nodes += 1
+
+        best = None
+        if self._table is not None:
+            key = self._table.key(board, player)
+            entry = self._table.probe(key)
+            if entry is not None:
+                best = entry[3]
+        actions = self._order(board, player, actions, best, depth)
+
+        act = actions[0]
+        board.flip(act[0], act[1], player)
+        try:
+            r, _ = self._alpha_beta_search(board, Board.opponent(player),
+                                           AlphaBeta.MIN_VAL, AlphaBeta.MAX_VAL,
+                                           depth-1, False)
+        finally:
+            board.undo()
+
+        black, white = board.bits
+        tasks = [(black, white, player, a, depth, r, self._generation, self._deadline) for a in actions[1:]]
+        for a, (v, nodes, leaves) in zip(actions[1:], self._pool.map(_search_split, tasks)):
+            if v is None:
+                raise SearchTimeout()
+            self._nodes += nodes
+            self._leaves += leaves
+            if v > r:
+                r, act = v, a
+        if self._table is not None:
+            self._store(key, r, depth, AlphaBeta.MIN_VAL, AlphaBeta.MAX_VAL, act)
         return r, act
 
 class Agent(object):
@@ -82,6 +687,9 @@ class Agent(object):
     def end_of_game(self, board):
         pass
 
+    def close(self):
+        pass
+
     @property
     def role(self):
         return self._role
@@ -91,22 +699,103 @@ class Agent(object):
         self._role = value
 
 class Bot(Agent):
-    def __init__(self, evaluator, depth, final_depth, role):
+    def __init__(self, evaluator, depth, final_depth, role, table=None, time_limit=None, book=None,
+                 batch=False, workers=1, search="alphabeta", collect_stats=False):
+        """`table` is the transposition table of the midgame search, pass
+        the same one to both bots of a game to share it. It only holds
+        for one set of evaluator weights, invalidate it when they change.
+
+        With `time_limit` (seconds per move) the midgame search deepens
+        iteratively, `depth` then caps it (None for no cap).
+
+        From `final_depth` empty squares on the game is solved exactly,
+        the value is then the final disc difference for `role`.
+
+        An `OpeningBook` is consulted before searching, its value is the
+        mean final disc difference of the book move for `role`.
+
+        With `batch` the leaves of the midgame search are evaluated in
+        batches, see `AlphaBeta`. With more than one of `workers` the
+        root moves are searched in parallel, see `ParallelAlphaBeta`.
+
+        `search` is "alphabeta" or "pvs" (`PrincipalVariation`, serial
+        only).
+
+        With `collect_stats` every move is described in `stats` and
+        appended to `game_stats`, which `begin_of_game` clears, and the
+        evaluator is profiled. Off by default, callers driving `_play`
+        themselves (self-play) would otherwise keep every move.
+        """
         super(Bot, self).__init__(role)
-        self._default_searcher = AlphaBeta(ScorerWrapper(role, evaluator),
-                                           depth)
-        self._final_searcher = AlphaBeta(ScorerWrapper(role, CountScorer()),
-                                         final_depth)
+        if search not in ("alphabeta", "pvs"):
+            raise Exception("Unknown search:{0}".format(search))
+        if search == "pvs" and workers > 1:
+            raise Exception("pvs search is serial only, got workers:{0}".format(workers))
+        if table is None:
+            table = TranspositionTable()
+        if search == "pvs":
+            self._default_searcher = PrincipalVariation(ScorerWrapper(role, evaluator),
+                                                        depth, table, time_limit, batch)
+        elif workers > 1:
+            self._default_searcher = ParallelAlphaBeta(ScorerWrapper(role, evaluator),
+                                                       depth, table, time_limit, batch, workers)
+        else:
+            self._default_searcher = AlphaBeta(ScorerWrapper(role, evaluator),
+                                               depth, table, time_limit, batch)
+        self._final_searcher = EndgameSolver()
         self._final_depth = final_depth
+        self._book = book
+        self._evaluator = evaluator
+        self._collect_stats = collect_stats
+        self._default_searcher.profile = collect_stats
+        self.stats = {}
+        self.game_stats = []
+
+    def begin_of_game(self, board):
+        self.game_stats = []
+
+    def close(self):
+        """Stops the search processes, if any.
+        """
+        self._default_searcher.close()
 
     def _play(self, board):
-        if board.blanks <= self._final_depth:
-            r, action = self._final_searcher.search(board, self.role)
+        start = time.time()
+        hit = None
+        if self._book is not None:
+            hit = self._book.best_move(board, self.role)
+        if hit is not None:
+            r, action = hit
+            source = "book"
+        elif board.blanks <= self._final_depth:
+            r, action = self._final_searcher.solve(board, self.role)
+            source = "endgame"
         else:
             r, action = self._default_searcher.search(board, self.role)
+            source = "search"
+        if not self._collect_stats:
+            return r, action
+
+        stats = {"empties": board.blanks, "source": source}
+        if source == "endgame":
+            stats["nodes"] = self._final_searcher.nodes
+        elif source == "search":
+            stats.update(self._default_searcher.stats)
+        stats["seconds"] = time.time() - start
+        stats["value"] = float(r)
+        stats["move"] = action
+        stats["board_caches"] = board.cache_stats()
+        if hasattr(self._evaluator, "stats"):
+            stats["evaluator"] = self._evaluator.stats()
+        self.stats = stats
+        self.game_stats.append(stats)
         return r, action
 
     def play(self, board):
+        """Returns the move. With `collect_stats`, `stats` then describes
+        how it was chosen and `game_stats` holds those of the moves of the
+        game so far.
+        """
         return self._play(board)[1]
 
 
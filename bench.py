@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import time
+
+import numpy as np
+
+import bitboard
+from othello import Board
+from database import TextDb, ThorDb, _game_positions
+from value import ModelScorer, ScorerWrapper
+from ai import AlphaBeta, ParallelAlphaBeta, PrincipalVariation, TranspositionTable
+from endgame import EndgameSolver
+from perft import perft
+
+def database_positions(db_file, n=20, ply=20, empties=None, seed=0):
+    """(black, white, player to move) of `n` positions of games drawn
+    from a WTHOR or text database, the same for the same seed. A position
+    is taken after `ply` moves or, with `empties`, when that many squares
+    are left empty.
+    """
+    if db_file.lower().endswith((".wtb", ".zip")):
+        games = ThorDb(db_file, stream=True).games
+    else:
+        games = TextDb(db_file).games
+    rng = np.random.RandomState(seed)
+    # reservoir sampling over the games reaching such a position
+    positions = []
+    seen = 0
+    for moves, _ in games:
+        for black, white, player, k in _game_positions(moves):
+            if player == Board.BLANK:
+                continue
+            if empties is not None:
+                found = 64 - bitboard.popcount(black | white) == empties
+            else:
+                found = k == ply
+            if found:
+                seen += 1
+                if len(positions) < n:
+                    positions.append((black, white, player))
+                else:
+                    j = rng.randint(seen)
+                    if j < n:
+                        positions[j] = (black, white, player)
+                break
+    return positions
+
+def bench_movegen(positions, depth):
+    """Leaf nodes per second of a perft to `depth` from the positions,
+    through `Board` (uncached `feasible_pos`, `flip` and `undo`) and on
+    raw bitboards. Every leaf is played, see `perft.py`.
+    """
+    results = []
+    for engine in ("board", "bitboard"):
+        leaves = 0
+        start = time.time()
+        for black, white, player in positions:
+            leaves += perft(black, white, player, depth, engine, bulk=False)
+        elapsed = time.time() - start
+        results.append({ "engine": engine,
+                         "depth": depth,
+                         "leaves": leaves,
+                         "seconds": elapsed,
+                         "leaves_per_second": leaves / elapsed })
+    return results
+
+def bench_evaluation(positions, model_file, batch_size=256):
+    """Evaluations per second of a `ModelScorer` called one position at
+    a time (each position once, so the feature cache doesn't help) and
+    through `evaluate_many`.
+    """
+    model = ModelScorer(model_file)
+    boards = []
+    for black, white, _ in positions:
+        b = Board()
+        b.set_bits(black, white)
+        boards.append(b)
+    start = time.time()
+    for b in boards:
+        model(b)
+    single = time.time() - start
+
+    cells = bitboard.to_array(np.array([p[0] for p in positions], dtype=np.uint64),
+                              np.array([p[1] for p in positions], dtype=np.uint64))
+    start = time.time()
+    for k in range(0, len(cells), batch_size):
+        model.evaluate_many(cells[k:k+batch_size])
+    batched = time.time() - start
+    return [{ "mode": "single", "positions": len(boards), "seconds": single,
+              "evaluations_per_second": len(boards) / single },
+            { "mode": "batch", "positions": len(cells), "batch_size": batch_size, "seconds": batched,
+              "evaluations_per_second": len(cells) / batched }]
+
+def bench_update(positions, model_file, repeat=5):
+    """Microseconds per `ModelScorer.update` of the positions, dense and
+    sparse, for each optimizer. The features are extracted beforehand.
+    """
+    boards = []
+    for black, white, _ in positions:
+        b = Board()
+        b.set_bits(black, white)
+        boards.append(b)
+    targets = np.random.RandomState(0).uniform(-1.0, 1.0, len(boards))
+    results = []
+    for optimizer in ("sgd", "adadelta"):
+        for sparse in (False, True):
+            model = ModelScorer(model_file, learning_rate=0.001, optimizer=optimizer, sparse=sparse)
+            for b in boards:
+                model._feature_extract(b)
+            start = time.time()
+            for _ in range(repeat):
+                for b, y in zip(boards, targets):
+                    model.update(b, y)
+            elapsed = time.time() - start
+            results.append({ "optimizer": optimizer,
+                             "sparse": sparse,
+                             "updates": repeat * len(boards),
+                             "seconds": elapsed,
+                             "microseconds_per_update": 1e6 * elapsed / (repeat * len(boards)) })
+    return results
+
+def bench_search(positions, model, depths):
+    """Nodes per second of fixed depth `AlphaBeta` searches of the
+    positions, with a transposition table.
+    """
+    results = []
+    for depth in depths:
+        searchers = dict((p, AlphaBeta(ScorerWrapper(p, model), depth, TranspositionTable()))
+                         for p in (Board.BLACK, Board.WHITE))
+        b = Board()
+        start = time.time()
+        for black, white, player in positions:
+            b.set_bits(black, white)
+            searchers[player].search(b, player)
+        elapsed = time.time() - start
+        nodes = sum(s.nodes for s in searchers.values())
+        results.append({ "depth": depth,
+                         "positions": len(positions),
+                         "nodes": nodes,
+                         "seconds": elapsed,
+                         "nodes_per_second": nodes / elapsed })
+    return results
+
+def bench_endgame(db_file, empties, n=5, seed=0):
+    """Exact and win/loss/draw solve times of positions with each number
+    of `empties`.
+    """
+    results = []
+    for e in empties:
+        positions = database_positions(db_file, n, empties=e, seed=seed)
+        for exact in (True, False):
+            solver = EndgameSolver(exact)
+            times = []
+            nodes = 0
+            for black, white, player in positions:
+                p, o = (black, white) if player == Board.BLACK else (white, black)
+                start = time.time()
+                solver.solve_bits(p, o)
+                times.append(time.time() - start)
+                nodes += solver.nodes
+            results.append({ "empties": e,
+                             "exact": exact,
+                             "positions": len(positions),
+                             "nodes": nodes,
+                             "seconds": sum(times),
+                             "max_seconds": max(times),
+                             "nodes_per_second": nodes / sum(times) })
+    return results
+
+def bench_parallel_search(positions, model, depth, workers=(1, 2, 4)):
+    """Time and nodes of fixed depth searches of the positions, serial
+    and split over each number of workers, with the speedup over serial.
+    """
+    results = []
+    values = None
+    for w in workers:
+        b = Board()
+        elapsed = 0.0
+        nodes = 0
+        vals = []
+        searchers = {}
+        for p in (Board.BLACK, Board.WHITE):
+            if w > 1:
+                searchers[p] = ParallelAlphaBeta(ScorerWrapper(p, model), depth, TranspositionTable(), workers=w)
+            else:
+                searchers[p] = AlphaBeta(ScorerWrapper(p, model), depth, TranspositionTable())
+        try:
+            for black, white, player in positions:
+                b.set_bits(black, white)
+                s = searchers[player]
+                if w > 1:
+                    s.start()
+                start = time.time()
+                v, _ = s.search(b, player)
+                elapsed += time.time() - start
+                vals.append(v)
+            nodes = sum(s.nodes for s in searchers.values())
+        finally:
+            for s in searchers.values():
+                if w > 1:
+                    s.close()
+        if values is None:
+            values = vals
+        results.append({ "workers": w,
+                         "seconds": elapsed,
+                         "nodes": nodes,
+                         "speedup": results[0]["seconds"] / elapsed if results else 1.0,
+                         "same_values": bool(np.allclose(vals, values)) })
+    return results
+
+def bench_search_variants(positions, model, depth):
+    """Nodes and time of `AlphaBeta` and `PrincipalVariation` searching
+    the positions, at a fixed depth and deepening iteratively to it (where
+    the aspiration windows of the latter apply), with a transposition
+    table.
+    """
+    results = []
+    for name, cls in (("alphabeta", AlphaBeta), ("pvs", PrincipalVariation)):
+        for iterative in (False, True):
+            # a time limit nobody reaches turns on iterative deepening
+            time_limit = 1e9 if iterative else None
+            searchers = dict((p, cls(ScorerWrapper(p, model), depth, TranspositionTable(), time_limit))
+                             for p in (Board.BLACK, Board.WHITE))
+            b = Board()
+            values = []
+            start = time.time()
+            for black, white, player in positions:
+                b.set_bits(black, white)
+                values.append(searchers[player].search(b, player)[0])
+            results.append({ "search": name,
+                             "iterative": iterative,
+                             "seconds": time.time() - start,
+                             "nodes": sum(s.nodes for s in searchers.values()),
+                             "values": values })
+    reference = results[0]["values"]
+    for r in results:
+        r["same_values"] = bool(np.allclose(r.pop("values"), reference))
+    return results
+
+
+def _environment():
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return { "commit": commit,
+             "python": platform.python_version(),
+             "numpy": np.__version__,
+             "machine": platform.machine(),
+             "time": time.strftime("%Y-%m-%dT%H:%M:%S") }
+
+def compare(results, baseline):
+    """Ratios of the per second rates (and seconds) of `results` to
+    those of the same entries of `baseline`, another run's output.
+    """
+    ratios = {}
+    for suite, entries in results.items():
+        if not isinstance(entries, list) or not isinstance(baseline.get(suite), list):
+            continue
+        for k, (new, old) in enumerate(zip(entries, baseline[suite])):
+            for key, v in new.items():
+                if (key.endswith("per_second") or key == "seconds") and old.get(key):
+                    ratios["{}[{}].{}".format(suite, k, key)] = v / old[key]
+    return ratios
+
+
+SUITES = ["movegen", "eval", "search", "endgame", "variants", "parallel", "update"]
+
+import argparse
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--db", default="./database/ffo/WTH_1990.ZIP", help="WTHOR or text database to draw positions from")
+    parser.add_argument("--model", default="./model/model.cpt.npy.6", help="model file")
+    parser.add_argument("--positions", default=20, type=int, help="number of positions")
+    parser.add_argument("--ply", default=20, type=int, help="moves played in the positions")
+    parser.add_argument("--seed", default=0, type=int, help="random seed of the positions")
+    parser.add_argument("--perft-depth", default=4, type=int, help="move generation perft depth")
+    parser.add_argument("--eval-positions", default=2000, type=int, help="number of positions to evaluate")
+    parser.add_argument("--depths", default=[3, 4, 5], type=int, nargs="+", help="search depths")
+    parser.add_argument("--empties", default=[10, 12, 14], type=int, nargs="+", help="endgame empty squares")
+    parser.add_argument("--endgame-positions", default=5, type=int, help="endgame positions per number of empties")
+    parser.add_argument("--depth", default=5, type=int, help="search depth of the variants and parallel suites")
+    parser.add_argument("--workers", default=[1, 2, 4], type=int, nargs="+", help="numbers of search processes")
+    parser.add_argument("--suites", default=SUITES[:5], nargs="+", choices=SUITES, help="benchmarks to run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    model = ModelScorer(args.model)
+    positions = database_positions(args.db, args.positions, args.ply, seed=args.seed)
+    results = { "environment": _environment(), "args": vars(args) }
+    if "movegen" in args.suites:
+        results["movegen"] = bench_movegen(positions, args.perft_depth)
+    if "eval" in args.suites:
+        eval_positions = []
+        for k, ply in enumerate(range(10, 60, 10)):
+            eval_positions += database_positions(args.db, args.eval_positions // 5, ply, seed=args.seed + k)
+        results["eval"] = bench_evaluation(eval_positions, args.model)
+    if "update" in args.suites:
+        results["update"] = bench_update(positions, args.model)
+    if "search" in args.suites:
+        results["search"] = bench_search(positions, model, args.depths)
+    if "endgame" in args.suites:
+        results["endgame"] = bench_endgame(args.db, args.empties, args.endgame_positions, args.seed)
+    if "variants" in args.suites:
+        results["search_variants"] = bench_search_variants(positions, model, args.depth)
+    if "parallel" in args.suites:
+        results["parallel_search"] = bench_parallel_search(positions, model, args.depth, args.workers)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            results["compared_to_baseline"] = compare(results, json.load(f))
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Bitboard primitives for 8x8 othello.
+
+A position is a pair of 64 bit integers, one per color, where square
+(i, j) maps to bit ``i * 8 + j``.
+
+https://www.chessprogramming.org/Dumb7Fill
+"""
+import numpy as np
+
+FULL = 0xffffffffffffffff
+NOT_A_FILE = 0xfefefefefefefefe
+NOT_H_FILE = 0x7f7f7f7f7f7f7f7f
+INNER_FILES = NOT_A_FILE & NOT_H_FILE
+
+INIT_BLACK = (1 << 28) | (1 << 35)
+INIT_WHITE = (1 << 27) | (1 << 36)
+
+# (shift, mask applied to the opponent's discs) per direction, the mask
+# stops runs from wrapping around the board edge. Each entry is used
+# both as a left shift and as a right shift.
+_SHIFTS = [(1, INNER_FILES), (8, FULL), (9, INNER_FILES), (7, INNER_FILES)]
+
+_BITS = np.arange(64, dtype=np.uint64)
+
+if hasattr(int, "bit_count"):
+    def popcount(x):
+        return x.bit_count()
+else:
+    def popcount(x):
+        return bin(x).count("1")
+
+
+def squares(mask):
+    """Yields the indices of the set bits of ``mask`` in ascending order.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def moves_mask(p, o):
+    """Squares where the player owning ``p`` can move against ``o``.
+    """
+    moves = 0
+    for s, m in _SHIFTS:
+        om = o & m
+        t = om & (p << s)
+        t |= om & (t << s)
+        t |= om & (t << s)
+        t |= om & (t << s)
+        t |= om & (t << s)
+        t |= om & (t << s)
+        moves |= t << s
+    for s, m in _SHIFTS:
+        om = o & m
+        t = om & (p >> s)
+        t |= om & (t >> s)
+        t |= om & (t >> s)
+        t |= om & (t >> s)
+        t |= om & (t >> s)
+        t |= om & (t >> s)
+        moves |= t >> s
+    return moves & ~(p | o) & FULL
+
+
+def flip_mask(sq, p, o):
+    """Discs of ``o`` flipped when the owner of ``p`` plays at ``sq``.
+    """
+    x = 1 << sq
+    f = 0
+    for s, m in _SHIFTS:
+        om = o & m
+        t = 0
+        y = x << s
+        while y & om:
+            t |= y
+            y <<= s
+        if y & p:
+            f |= t
+    for s, m in _SHIFTS:
+        om = o & m
+        t = 0
+        y = x >> s
+        while y & om:
+            t |= y
+            y >>= s
+        if y & p:
+            f |= t
+    return f
+
+
+def to_array(black, white):
+    """Unpacks bitboards into BLANK(0)/BLACK(1)/WHITE(2) cells.
+
+    Scalars give a flat array of 64 cells, arrays of N positions give
+    an (N, 64) array.
+    """
+    b = (np.asarray(black, dtype=np.uint64)[..., None] >> _BITS) & np.uint64(1)
+    w = (np.asarray(white, dtype=np.uint64)[..., None] >> _BITS) & np.uint64(1)
+    return (b + 2 * w).astype(int)
+
+
+def from_array(board):
+    """Packs an 8x8 (or flat) array of cells into (black, white).
+    """
+    flat = np.asarray(board).reshape(64)
+    black = int(np.bitwise_or.reduce((flat == 1).astype(np.uint64) << _BITS))
+    white = int(np.bitwise_or.reduce((flat == 2).astype(np.uint64) << _BITS))
+    return black, white
+
+
+# https://www.chessprogramming.org/Flipping_Mirroring_and_Rotating
+
+def flip_vertical(x):
+    """Row i to row 7 - i.
+    """
+    return int.from_bytes(x.to_bytes(8, "little"), "big")
+
+
+def mirror_horizontal(x):
+    """Column j to column 7 - j.
+    """
+    x = ((x >> 1) & 0x5555555555555555) | ((x & 0x5555555555555555) << 1)
+    x = ((x >> 2) & 0x3333333333333333) | ((x & 0x3333333333333333) << 2)
+    x = ((x >> 4) & 0x0f0f0f0f0f0f0f0f) | ((x & 0x0f0f0f0f0f0f0f0f) << 4)
+    return x
+
+
+def flip_diagonal(x):
+    """Square (i, j) to (j, i).
+    """
+    t = 0x0f0f0f0f00000000 & (x ^ (x << 28))
+    x ^= t ^ (t >> 28)
+    t = 0x3333000033330000 & (x ^ (x << 14))
+    x ^= t ^ (t >> 14)
+    t = 0x5500550055005500 & (x ^ (x << 7))
+    x ^= t ^ (t >> 7)
+    return x
+
+
+def symmetries(black, white):
+    """The position under the 8 symmetries of the board.
+    """
+    b, w = black, white
+    for _ in range(2):
+        for _ in range(2):
+            yield b, w
+            yield mirror_horizontal(b), mirror_horizontal(w)
+            b, w = flip_vertical(b), flip_vertical(w)
+        b, w = flip_diagonal(b), flip_diagonal(w)
+
+
+def canonical(black, white):
+    """The smallest of the symmetric images of a position.
+    """
+    return min(symmetries(black, white))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+
+import bitboard
+from othello import Board
+
+BOOK_DTYPE = np.dtype([("black", "<u8"), ("white", "<u8"),
+                       ("games", "<u4"), ("black_wins", "<u4"), ("white_wins", "<u4"),
+                       ("score", "<i8")])
+
+def _slot(black, white, bits):
+    # splitmix style mixing of the canonical position, top `bits` bits
+    h = (black ^ (white * 0x9e3779b97f4a7c15)) & bitboard.FULL
+    h = ((h ^ (h >> 31)) * 0xbf58476d1ce4e5b9) & bitboard.FULL
+    return h >> (64 - bits)
+
+def build_book(games, output_file, plies=20, min_games=2):
+    """Aggregates the positions of the first `plies` moves of `games`
+    ((player, row, column) moves, final black disc difference) into an
+    open addressing table saved with numpy.
+
+    Positions are normalized over the 8 board symmetries and kept if
+    they were reached in at least `min_games` games.
+    """
+    stats = {}
+    for moves, result in games:
+        black, white = bitboard.INIT_BLACK, bitboard.INIT_WHITE
+        for p, r, c in moves[:plies]:
+            if p == Board.BLACK:
+                f = bitboard.flip_mask(r * 8 + c, black, white)
+                black |= f | (1 << (r * 8 + c))
+                white ^= f
+            else:
+                f = bitboard.flip_mask(r * 8 + c, white, black)
+                white |= f | (1 << (r * 8 + c))
+                black ^= f
+            key = bitboard.canonical(black, white)
+            s = stats.get(key)
+            if s is None:
+                s = stats[key] = [0, 0, 0, 0]
+            s[0] += 1
+            s[1] += result > 0
+            s[2] += result < 0
+            s[3] += result
+
+    entries = [(k, s) for k, s in stats.items() if s[0] >= min_games]
+    # at most half full
+    bits = max(1, (2 * len(entries)).bit_length())
+    table = np.zeros(1 << bits, dtype=BOOK_DTYPE)
+    mask = (1 << bits) - 1
+    for (black, white), s in entries:
+        i = _slot(black, white, bits)
+        while table["games"][i] != 0:
+            i = (i + 1) & mask
+        table[i] = (black, white, s[0], s[1], s[2], s[3])
+    np.save(output_file, table)
+    return len(entries)
+
+
+class OpeningBook(object):
+    """Memory mapped opening book written by `build_book`.
+    """
+    def __init__(self, path, min_games=10):
+        self._table = np.load(path, mmap_mode="r")
+        self._bits = len(self._table).bit_length() - 1
+        self._mask = len(self._table) - 1
+        self._min_games = min_games
+
+    def lookup(self, black, white):
+        """(games, black wins, white wins, black disc difference sum) of
+        a position, or None.
+        """
+        black, white = bitboard.canonical(black, white)
+        i = _slot(black, white, self._bits)
+        while True:
+            e = self._table[i]
+            if e["games"] == 0:
+                return None
+            if e["black"] == black and e["white"] == white:
+                return int(e["games"]), int(e["black_wins"]), int(e["white_wins"]), int(e["score"])
+            i = (i + 1) & self._mask
+
+    def best_move(self, board, player):
+        """(mean disc difference for `player`, move) of the book move
+        with the best mean result over at least `min_games` games, or
+        None if the position is out of book.
+        """
+        p, o = board.bits
+        if player == Board.WHITE:
+            p, o = o, p
+            sign = -1
+        else:
+            sign = 1
+        best = None
+        for sq in bitboard.squares(bitboard.moves_mask(p, o)):
+            f = bitboard.flip_mask(sq, p, o)
+            np_, no = p | f | (1 << sq), o ^ f
+            if player == Board.BLACK:
+                e = self.lookup(np_, no)
+            else:
+                e = self.lookup(no, np_)
+            if e is None or e[0] < self._min_games:
+                continue
+            v = sign * e[3] / float(e[0])
+            if best is None or v > best[0]:
+                best = (v, divmod(sq, 8))
+        return best
+
+
+import argparse
+if __name__ == '__main__':
+    import itertools
+    from database import ThorDb, TextDb
+    parser = argparse.ArgumentParser(prog="book.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--output", default="./model/book.npy", help="book file")
+    parser.add_argument("--plies", default=20, type=int, help="number of opening moves to keep")
+    parser.add_argument("--min-games", default=2, type=int, help="drop positions seen in fewer games")
+    parser.add_argument("databases", nargs="+", help="WTHOR (.wtb or .zip) or text databases")
+    args = parser.parse_args()
+
+    thor = ThorDb(stream=True)
+    text = []
+    for f in args.databases:
+        if f.lower().endswith((".wtb", ".zip")):
+            thor.add_file(f)
+        else:
+            text.append(f)
+    games = itertools.chain(thor.games, TextDb(*text).games)
+    n = build_book(games, args.output, args.plies, args.min_games)
+    print("positions = ", n)
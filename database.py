@@ -2,8 +2,14 @@
 from __future__ import print_function
 import struct
 import gzip
+import io
+import zipfile
+import zlib
 
-from othello import Board
+import numpy as np
+
+import bitboard
+from othello import Board, ArrayBoard
 
 def _move_to_str(move):
     player,row,column = move
@@ -21,58 +27,149 @@ def save_db_as_text(db, output_file):
 def _byte_to_int(b):
     return struct.unpack('b', b)[0]
 
+def _zip_members(f):
+    """Yields (name, data) of the members of a zip archive by walking
+    its local file headers, for archives whose central directory is
+    missing (e.g. truncated downloads). A truncated member yields as
+    much as can be inflated.
+    """
+    while True:
+        header = f.read(30)
+        if len(header) < 30 or header[:4] != b"PK\x03\x04":
+            return
+        _, _, flags, method, _, _, _, size, _, name_len, extra_len = struct.unpack("<4sHHHHHIIIHH", header)
+        name = f.read(name_len).decode("cp437")
+        f.read(extra_len)
+        if flags & 0x08:
+            # sizes follow the data, can't be walked without the directory
+            return
+        data = f.read(size)
+        if method == 8:
+            data = zlib.decompressobj(-15).decompress(data)
+        elif method != 0:
+            return
+        yield name, data
+
+def _thor_files(file_name):
+    """Yields binary file objects of a WTHOR file, or of the WTHOR
+    files in a zip archive.
+    """
+    if file_name.lower().endswith(".zip"):
+        try:
+            z = zipfile.ZipFile(file_name)
+        except zipfile.BadZipFile:
+            with open(file_name, "rb") as f:
+                for name, data in _zip_members(f):
+                    if name.lower().endswith(".wtb"):
+                        yield io.BytesIO(data)
+            return
+        with z:
+            for name in z.namelist():
+                if name.lower().endswith(".wtb"):
+                    with z.open(name) as f:
+                        yield f
+    else:
+        with open(file_name, "rb") as f:
+            yield f
+
+def _thor_records(f):
+    file_header_size = 16
+    record_size = 68
+
+    header = f.read(file_header_size)
+    if len(header) < file_header_size:
+        return
+    board_size = _byte_to_int(header[12:13])
+    if board_size == 8 or board_size == 0:
+        while True:
+            record = f.read(record_size)
+            if len(record) < record_size:
+                return
+            yield record
+
 class ThorDb(object):
     """WTHOR database format: http://cassio.free.fr/cassio/custom_install/database/FORMAT_WTHOR.TXT
+
+    Reads .wtb files and zip archives of them. With `stream` the games
+    are read from the files, one at a time, every time `games` is
+    iterated instead of being kept in memory. With `validate` games whose
+    final score doesn't match the recorded one are dropped.
     """
-    def __init__(self, *database_files):
+    def __init__(self, *database_files, stream=False, validate=True):
         self._games = []
+        self._files = []
+        self._stream = stream
+        self._validate = validate
         self.inconsistencies = 0
         for database_file in database_files:
             self.add_file(database_file)
 
     @property
     def games(self):
+        if self._stream:
+            return self.iter_games()
         return self._games
 
+    def iter_games(self):
+        for file_name in self._files:
+            for game in self._read_thor_file(file_name):
+                yield game
+
     def add_file(self, file_name):
-        self._games.extend(self._read_thor_file(file_name))
-        print("inconsistencies = ", self.inconsistencies)
+        if self._stream:
+            self._files.append(file_name)
+        else:
+            self._games.extend(self._read_thor_file(file_name))
+            print("inconsistencies = ", self.inconsistencies)
 
     def _read_thor_file(self, file_name):
-        file_header_size = 16
+        for f in _thor_files(file_name):
+            for record in _thor_records(f):
+                game = self._parse_record(record)
+                if game is not None:
+                    yield game
+
+    def _parse_record(self, record):
+        """Replays a game record on bitboards, the record leaves out
+        passes so the mover is whoever can play the square.
+        """
         record_header_size = 8
-        shots = 60
-        record_size = 68
 
-        games = []
-        with open(file_name, "rb") as f:
-            c = f.read()
-            board_size = _byte_to_int(c[12])
-            if board_size == 8 or board_size == 0:
-                for i in xrange(file_header_size, len(c), record_size):
-                    moves = []
-                    b = Board()
-                    player = Board.BLACK
-                    black_score = _byte_to_int(c[i+6])
-                    for j in xrange(record_header_size, record_size):
-                        play = _byte_to_int(c[i+j])
-                        if play > 0:
-                            column = (play % 10) -1
-                            row = (play // 10) -1
-                            if not b.is_feasible(row, column, player):
-                                player = Board.opponent(player)
-                            moves.append((player, row, column))
-                            b.flip(row, column, player)
-                            player = Board.opponent(player)
-
-                    score = b.score(Board.BLACK)
-                    if b.score(Board.BLACK) > b.score(Board.WHITE):
-                        score += b.score(Board.BLANK)
-                    if score == black_score:
-                        games.append((moves, black_score*2 - 64))
-                    else:
+        moves = []
+        black, white = bitboard.INIT_BLACK, bitboard.INIT_WHITE
+        player = Board.BLACK
+        black_score = _byte_to_int(record[6:7])
+        for play in bytearray(record[record_header_size:]):
+            if play > 0:
+                column = (play % 10) -1
+                row = (play // 10) -1
+                sq = row * 8 + column
+                if not (0 <= row < 8 and 0 <= column < 8):
+                    self.inconsistencies += 1
+                    return None
+                p, o = (black, white) if player == Board.BLACK else (white, black)
+                f = bitboard.flip_mask(sq, p, o)
+                if f == 0 or (p | o) >> sq & 1:
+                    player = Board.opponent(player)
+                    p, o = o, p
+                    f = bitboard.flip_mask(sq, p, o)
+                    if f == 0 or (p | o) >> sq & 1:
                         self.inconsistencies += 1
-        return games
+                        return None
+                p |= f | (1 << sq)
+                o ^= f
+                black, white = (p, o) if player == Board.BLACK else (o, p)
+                moves.append((player, row, column))
+                player = Board.opponent(player)
+
+        if self._validate:
+            score = bitboard.popcount(black)
+            if score > bitboard.popcount(white):
+                score = 64 - bitboard.popcount(white)
+            if score != black_score:
+                self.inconsistencies += 1
+                return None
+        return (moves, black_score*2 - 64)
 
 class TextDb(object):
     def __init__(self, *db_files):
@@ -103,7 +200,7 @@ class TextDb(object):
     def _read_text_file(self, file_name):
         games = []
         if file_name.endswith(".gz"):
-            f = gzip.open(file_name)
+            f = gzip.open(file_name, "rt")
         else:
             f = open(file_name)
         for l in f:
@@ -124,10 +221,111 @@ class TextDb(object):
             row = ord(l[3*idx+1]) - ord('a')
             column = int(l[3*idx+2]) - 1
             moves.append((player, row, column))
-        result = int(tokens[1])
+        result = int(tokens[1].split()[0])
         return (moves, result)
 
 
+# fixed size records of the binary format. A game holds its moves as
+# square + 1, negated for white, padded with zeros.
+GAME_DTYPE = np.dtype([("moves", "i1", (60,)), ("length", "u1"), ("result", "i1")])
+# a position after a move of a game: bitboards, the player to move
+# next (BLANK once the game is over), number of moves played, the final
+# black disc difference and the index of the game
+POSITION_DTYPE = np.dtype([("black", "<u8"), ("white", "<u8"), ("player", "u1"), ("ply", "u1"),
+                           ("result", "i1"), ("game", "<u4")])
+
+def _game_positions(moves):
+    black, white = bitboard.INIT_BLACK, bitboard.INIT_WHITE
+    for ply, (p, r, c) in enumerate(moves, 1):
+        sq = r * 8 + c
+        if p == Board.BLACK:
+            f = bitboard.flip_mask(sq, black, white)
+            black |= f | (1 << sq)
+            white ^= f
+        else:
+            f = bitboard.flip_mask(sq, white, black)
+            white |= f | (1 << sq)
+            black ^= f
+        if p == Board.BLACK:
+            mover, other = black, white
+        else:
+            mover, other = white, black
+        if bitboard.moves_mask(other, mover):
+            player = Board.opponent(p)
+        elif bitboard.moves_mask(mover, other):
+            player = p
+        else:
+            player = Board.BLANK
+        yield black, white, player, ply
+
+def save_db_as_binary(games, games_file, positions_file=None, chunk_size=4096):
+    """Writes `games` ((moves, result) pairs, e.g. the games of a
+    database) as GAME_DTYPE records to `games_file`
+    and, with `positions_file`, every position reached in them as
+    POSITION_DTYPE records, both with `numpy.save`.
+    """
+    chunks, positions = [], []
+    game_chunk = np.zeros(chunk_size, dtype=GAME_DTYPE)
+    position_chunk = []
+    n = 0
+    for moves, result in games:
+        g = game_chunk[n % chunk_size]
+        g["moves"][:] = 0
+        g["moves"][:len(moves)] = [(r * 8 + c + 1) * (1 if p == Board.BLACK else -1) for p, r, c in moves]
+        g["length"] = len(moves)
+        g["result"] = result
+        if positions_file is not None:
+            position_chunk.extend((b, w, p, ply, result, n) for b, w, p, ply in _game_positions(moves))
+            if len(position_chunk) >= chunk_size:
+                positions.append(np.array(position_chunk, dtype=POSITION_DTYPE))
+                position_chunk = []
+        n += 1
+        if n % chunk_size == 0:
+            chunks.append(game_chunk.copy())
+    chunks.append(game_chunk[:n % chunk_size])
+    np.save(games_file, np.concatenate(chunks))
+    if positions_file is not None:
+        positions.append(np.array(position_chunk, dtype=POSITION_DTYPE))
+        np.save(positions_file, np.concatenate(positions))
+    return n
+
+class BinaryDb(object):
+    """Memory mapped games (and positions) written by `save_db_as_binary`.
+    """
+    def __init__(self, games_file, positions_file=None):
+        self._records = np.load(games_file, mmap_mode="r")
+        self._positions = None
+        if positions_file is not None:
+            self._positions = np.load(positions_file, mmap_mode="r")
+
+    @property
+    def records(self):
+        return self._records
+
+    @property
+    def positions(self):
+        return self._positions
+
+    @property
+    def games(self):
+        """(moves, result) of the games, like `TextDb.games`.
+        """
+        for g in self._records:
+            moves = []
+            for m in g["moves"][:g["length"]].tolist():
+                if m > 0:
+                    moves.append((Board.BLACK,) + divmod(m - 1, 8))
+                else:
+                    moves.append((Board.WHITE,) + divmod(-m - 1, 8))
+            yield moves, int(g["result"])
+
+    def boards(self, idx=slice(None)):
+        """(N, 64) cells of the positions at `idx`.
+        """
+        p = self._positions[idx]
+        return bitboard.to_array(p["black"], p["white"])
+
+
 def validate(db):
     import random
     for moves, result in db.games:
@@ -144,7 +342,56 @@ def validate(db):
             score = b.score(Board.BLANK) + black_score
         assert result in (black_score-white_score, 2*score - 64)
 
+def check_board_parity(db, sample=1.0):
+    """Replays games on both the bitboard `Board` and the reference
+    `ArrayBoard`, asserting they agree after every move.
+    """
+    import random
+    n = 0
+    for moves, result in db.games:
+        if random.random() >= sample:
+            continue
+        b = Board()
+        a = ArrayBoard()
+        for p,r,c in moves:
+            for q in (Board.BLACK, Board.WHITE):
+                assert b.feasible_pos(q, False) == a.feasible_pos(q, False)
+                assert b.moves_mask(q) == a.moves_mask(q)
+            assert b.is_terminal_state() == a.is_terminal_state()
+            assert b.flip_mask(r,c,p) == a.flip_mask(r,c,p)
+            b.flip(r,c,p)
+            a.flip(r,c,p)
+            assert (b.board == a.board).all()
+            assert b.bits == a.bits
+            assert b.blanks == a.blanks
+        for q in (Board.BLANK, Board.BLACK, Board.WHITE):
+            assert b.score(q) == a.score(q)
+        assert b.is_terminal_state() == a.is_terminal_state()
+        n += 1
+    return n
+
+
+import argparse
 if __name__ == '__main__':
-    database_files = ["./database/train.small.txt"]
-    db = TextDb(*database_files)
-    validate(db)
+    parser = argparse.ArgumentParser(prog="database.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--binary", help="convert the databases to a binary games file")
+    parser.add_argument("--positions", help="with --binary, also write the positions to this file")
+    parser.add_argument("databases", nargs="*", default=["./database/skatgame/logbook.gam.gz"],
+                        help="WTHOR (.wtb or .zip) or text databases")
+    args = parser.parse_args()
+
+    thor_files = [f for f in args.databases if f.lower().endswith((".wtb", ".zip"))]
+    text_files = [f for f in args.databases if not f.lower().endswith((".wtb", ".zip"))]
+    if args.binary is not None:
+        import itertools
+        games = itertools.chain(ThorDb(*thor_files, stream=True).games, TextDb(*text_files).games)
+        print("games = ", save_db_as_binary(games, args.binary, args.positions))
+    else:
+        dbs = []
+        if thor_files:
+            dbs.append(ThorDb(*thor_files, stream=True))
+        if text_files:
+            dbs.append(TextDb(*text_files))
+        for db in dbs:
+            validate(db)
+            print("games checked for board parity = ", check_board_parity(db, 0.01))
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Exact endgame search on bitboards.
+
+https://www.chessprogramming.org/Endgame
+http://www.radagast.se/othello/endgame.c
+"""
+from bitboard import popcount, moves_mask, flip_mask, squares
+from othello import Board
+
+A_FILE = 0x0101010101010101
+H_FILE = 0x8080808080808080
+EDGES = 0xff818181818181ff
+
+# squares tried first when ordering is static: corners, edges away
+# from the corners, then inwards, x-squares last
+_PRIORITY = [
+    9, 3, 7, 6, 6, 7, 3, 9,
+    3, 0, 4, 4, 4, 4, 0, 3,
+    7, 4, 5, 5, 5, 5, 4, 7,
+    6, 4, 5, 5, 5, 5, 4, 6,
+    6, 4, 5, 5, 5, 5, 4, 6,
+    7, 4, 5, 5, 5, 5, 4, 7,
+    3, 0, 4, 4, 4, 4, 0, 3,
+    9, 3, 7, 6, 6, 7, 3, 9,
+]
+
+_QUADRANT = [1 << ((sq >> 5) * 2 + ((sq & 7) >> 2)) for sq in range(64)]
+
+# alpha from which bounding the score by the opponent's stable discs
+# is worth trying, per number of empty squares
+_STABILITY_THRESHOLD = [65] * 4 + [min(64, 2 * e - 2) for e in range(4, 65)]
+
+
+def _lines():
+    lines = [[], [], [], []]
+    for r in range(8):
+        lines[0].append(sum(1 << (r * 8 + c) for c in range(8)))
+        lines[1].append(sum(1 << (c * 8 + r) for c in range(8)))
+    for d in range(-7, 8):
+        lines[2].append(sum(1 << (r * 8 + r - d) for r in range(8) if 0 <= r - d < 8))
+        lines[3].append(sum(1 << (r * 8 + d + 7 - r) for r in range(8) if 0 <= d + 7 - r < 8))
+    return lines
+
+_LINES = _lines()
+
+
+def stable_discs(p, o):
+    """A subset of the discs of `p` that can never be flipped: those with,
+    along each of the four axes, a full line, the board edge or a stable
+    disc of their own next to them.
+    """
+    occupied = p | o
+    full = []
+    for lines in _LINES:
+        f = 0
+        for line in lines:
+            if occupied & line == line:
+                f |= line
+        full.append(f)
+    h = full[0] | A_FILE | H_FILE
+    v = full[1] | 0xff000000000000ff
+    d1 = full[2] | EDGES
+    d2 = full[3] | EDGES
+    stable = 0
+    while True:
+        s = (p &
+             (h | ((stable << 1) & ~A_FILE) | ((stable >> 1) & ~H_FILE)) &
+             (v | (stable << 8) | (stable >> 8)) &
+             (d1 | ((stable << 9) & ~A_FILE) | ((stable >> 9) & ~H_FILE)) &
+             (d2 | ((stable << 7) & ~H_FILE) | ((stable >> 7) & ~A_FILE)))
+        if s == stable:
+            return stable
+        stable = s
+
+
+class EndgameSolver(object):
+    """Negamax alpha-beta to the end of the game. Values are final disc
+    differences from the point of view of the player to move.
+
+    In exact mode the value is the exact disc difference, otherwise the
+    search uses the null window (-1, 1) and only the sign of the value
+    (win, draw or loss) is exact.
+
+    Moves are ordered fastest-first (fewest opponent replies) while more
+    than FASTEST_FIRST squares are empty, below that by walking a linked
+    list of empty squares, odd parity regions first.
+    """
+    FASTEST_FIRST = 6
+    _HEAD = 64
+
+    def __init__(self, exact=True):
+        self._exact = exact
+        self.nodes = 0
+        self._next = [0] * 65
+        self._prev = [0] * 65
+        self._parity = 0
+
+    @property
+    def exact(self):
+        return self._exact
+
+    @exact.setter
+    def exact(self, val):
+        self._exact = val
+
+    def _init_empties(self, occupied):
+        empties = [sq for sq in range(64) if not (occupied >> sq) & 1]
+        empties.sort(key=lambda sq: -_PRIORITY[sq])
+        prev = EndgameSolver._HEAD
+        self._parity = 0
+        for sq in empties:
+            self._next[prev] = sq
+            self._prev[sq] = prev
+            self._parity ^= _QUADRANT[sq]
+            prev = sq
+        self._next[prev] = EndgameSolver._HEAD
+        self._prev[EndgameSolver._HEAD] = prev
+
+    def _remove(self, sq):
+        self._next[self._prev[sq]] = self._next[sq]
+        self._prev[self._next[sq]] = self._prev[sq]
+        self._parity ^= _QUADRANT[sq]
+
+    def _restore(self, sq):
+        self._next[self._prev[sq]] = sq
+        self._prev[self._next[sq]] = sq
+        self._parity ^= _QUADRANT[sq]
+
+    def solve(self, board, player):
+        """Returns (value, move) for `player` on `board`, move is None if
+        `player` has to pass.
+        """
+        p, o = board.bits
+        if player == Board.WHITE:
+            p, o = o, p
+        v, sq = self.solve_bits(p, o)
+        if sq is None:
+            return v, None
+        return v, divmod(sq, 8)
+
+    def solve_bits(self, p, o):
+        """Returns (value, square) for the player owning `p`.
+        """
+        self.nodes = 0
+        self._init_empties(p | o)
+        empties = 64 - popcount(p | o)
+        if self._exact:
+            alpha, beta = -64, 64
+        else:
+            alpha, beta = -1, 1
+
+        if not moves_mask(p, o):
+            return self._search(p, o, alpha, beta, empties), None
+        best, best_sq = -65, None
+        for sq, f in self._ordered(p, o, moves_mask(p, o)):
+            self._remove(sq)
+            v = -self._search(o ^ f, p | f | (1 << sq), -beta, -alpha, empties - 1)
+            self._restore(sq)
+            if v > best:
+                best, best_sq = v, sq
+            if v > alpha:
+                alpha = v
+            if alpha >= beta:
+                break
+        return best, best_sq
+
+    def _ordered(self, p, o, moves):
+        """(square, flipped) of the moves, fastest-first.
+        """
+        keyed = []
+        for sq in squares(moves):
+            f = flip_mask(sq, p, o)
+            mobility = popcount(moves_mask(o ^ f, p | f | (1 << sq)))
+            keyed.append((mobility * 16 - _PRIORITY[sq], sq, f))
+        keyed.sort()
+        return [(sq, f) for _, sq, f in keyed]
+
+    def _last(self, p, o, sq):
+        # the disc difference if nobody can play the last square
+        v = 2 * popcount(p) - 63
+        f = flip_mask(sq, p, o)
+        if f:
+            return v + 2 * popcount(f) + 1
+        f = flip_mask(sq, o, p)
+        if f:
+            return v - 2 * popcount(f) - 1
+        return v
+
+    def _search(self, p, o, alpha, beta, empties):
+        self.nodes += 1
+        if empties == 0:
+            return 2 * popcount(p) - 64
+        if empties == 1:
+            return self._last(p, o, self._next[EndgameSolver._HEAD])
+
+        if alpha >= _STABILITY_THRESHOLD[empties]:
+            bound = 64 - 2 * popcount(stable_discs(o, p))
+            if bound <= alpha:
+                return bound
+            if bound < beta:
+                beta = bound
+
+        moves = moves_mask(p, o)
+        if not moves:
+            if not moves_mask(o, p):
+                return popcount(p) - popcount(o)
+            return -self._search(o, p, -beta, -alpha, empties)
+
+        if empties > EndgameSolver.FASTEST_FIRST:
+            candidates = self._ordered(p, o, moves)
+        else:
+            odd, even = [], []
+            sq = self._next[EndgameSolver._HEAD]
+            while sq != EndgameSolver._HEAD:
+                if (moves >> sq) & 1:
+                    if self._parity & _QUADRANT[sq]:
+                        odd.append(sq)
+                    else:
+                        even.append(sq)
+                sq = self._next[sq]
+            candidates = [(sq, flip_mask(sq, p, o)) for sq in odd + even]
+
+        best = -65
+        for sq, f in candidates:
+            self._remove(sq)
+            v = -self._search(o ^ f, p | f | (1 << sq), -beta, -alpha, empties - 1)
+            self._restore(sq)
+            if v > best:
+                best = v
+                if v > alpha:
+                    alpha = v
+                    if alpha >= beta:
+                        break
+        return best
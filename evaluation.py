@@ -1,37 +1,120 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-from database import TextDb
+import itertools
+import multiprocessing as mp
+
+import numpy as np
+
+import bitboard
+from database import ThorDb, TextDb, _game_positions
 from value import ModelScorer
 from othello import Board
 
-import math
-import numpy as np
+NUM_OF_STAGES = 60 // 9 + 1
 
-def evaluate(db, models):
-    error_sum = [0.0] * len(models)
-    n = 0.0
-    for moves, result in db.games:
-        if np.random.rand() > 0.1:
+def sample_positions(games, sample=0.1, min_ply=10, seed=None):
+    """(black, white, result) arrays of the positions past the first
+    `min_ply` moves of a `sample` fraction of `games`, the sample only
+    depends on `seed`.
+    """
+    rng = np.random.RandomState(seed)
+    black, white, result = [], [], []
+    for moves, r in games:
+        if rng.rand() >= sample:
             continue
-        b = Board()
-        steps = 0
-        for p, r, c in moves:
-            steps += 1
-            b.flip(r, c, p)
-            if steps > 10:
-                for i, m in enumerate(models):
-                    error = m(b) - result
-                    error_sum[i] += error * error
-                n += 1.0
-    return [ math.sqrt(err/n) for err in error_sum ]
+        for b, w, _, ply in _game_positions(moves):
+            if ply > min_ply:
+                black.append(b)
+                white.append(w)
+                result.append(r)
+    return (np.array(black, dtype=np.uint64), np.array(white, dtype=np.uint64),
+            np.array(result, dtype=np.float64))
+
+def _squared_errors(models, black, white, result, batch_size=4096):
+    """Per model and stage sums of squared errors, and per stage counts.
+    """
+    errors = np.zeros((len(models), NUM_OF_STAGES))
+    counts = np.zeros(NUM_OF_STAGES)
+    for k in range(0, len(result), batch_size):
+        boards = bitboard.to_array(black[k:k+batch_size], white[k:k+batch_size])
+        stage = np.sum(boards == Board.BLANK, axis=1) // 9
+        counts += np.bincount(stage, minlength=NUM_OF_STAGES)
+        for i, m in enumerate(models):
+            err = m.evaluate_many(boards) - result[k:k+batch_size]
+            errors[i] += np.bincount(stage, weights=err * err, minlength=NUM_OF_STAGES)
+    return errors, counts
+
+_worker_models = None
+
+def _init_worker(models):
+    global _worker_models
+    _worker_models = models
 
+def _run_chunk(chunk):
+    return _squared_errors(_worker_models, *chunk)
+
+def evaluate_positions(models, black, white, result, workers=0):
+    """Returns the RMSE of each model over all positions and per stage
+    (9 empty squares each, NaN for stages without positions). With
+    `workers` the positions are split over processes.
+    """
+    if workers > 0:
+        chunks = [(black[i::workers], white[i::workers], result[i::workers]) for i in range(workers)]
+        pool = mp.Pool(workers, initializer=_init_worker, initargs=(models,))
+        try:
+            parts = pool.map(_run_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        errors = sum(e for e, _ in parts)
+        counts = sum(c for _, c in parts)
+    else:
+        errors, counts = _squared_errors(models, black, white, result)
+    total = np.sqrt(errors.sum(axis=1) / max(1, counts.sum()))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        by_stage = np.sqrt(errors / counts)
+    return total, by_stage
+
+def evaluate(db, models, sample=0.1, seed=None):
+    black, white, result = sample_positions(db.games, sample, seed=seed)
+    total, _ = evaluate_positions(models, black, white, result)
+    return [float(e) for e in total]
+
+
+import argparse
 if __name__ == '__main__':
-    model1 = ModelScorer()
-    model1.load("/Users/qiyiping/Projects/qiyiping/othello/model/model.cpt.npy.6")
-    model2 = ModelScorer()
-    model2.load("/Users/qiyiping/Projects/qiyiping/othello/model/model.cpt.npy")
-    db = TextDb("./database/validate.small.txt")
-    res = evaluate(db, [model1, model2])
-    for i, mse in enumerate(res):
-        print(f"Model Index:{i}, MSE: {mse}")
+    parser = argparse.ArgumentParser(prog="evaluation.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--db", nargs="+", default=["./database/ffo/WTH_2016.ZIP"],
+                        help="WTHOR (.wtb or .zip) or text databases")
+    parser.add_argument("--positions", help="positions file written by database.py --positions, instead of --db")
+    parser.add_argument("--sample", default=0.1, type=float, help="fraction of games to evaluate on")
+    parser.add_argument("--min-ply", default=10, type=int, help="skip positions of the first moves")
+    parser.add_argument("--seed", default=0, type=int, help="random seed of the sample")
+    parser.add_argument("--workers", default=0, type=int, help="evaluate over this many processes")
+    parser.add_argument("models", nargs="*", default=["./model/model.cpt.npy.6"], help="model files")
+    args = parser.parse_args()
+
+    models = []
+    for path in args.models:
+        m = ModelScorer()
+        m.load(path)
+        models.append(m)
+
+    if args.positions is not None:
+        p = np.load(args.positions, mmap_mode="r")
+        rng = np.random.RandomState(args.seed)
+        games = np.unique(p["game"])
+        p = p[np.isin(p["game"], games[rng.rand(len(games)) < args.sample]) & (p["ply"] > args.min_ply)]
+        black, white, result = np.array(p["black"]), np.array(p["white"]), np.array(p["result"], dtype=np.float64)
+    else:
+        thor_files = [f for f in args.db if f.lower().endswith((".wtb", ".zip"))]
+        text_files = [f for f in args.db if not f.lower().endswith((".wtb", ".zip"))]
+        games = itertools.chain(ThorDb(*thor_files, stream=True).games, TextDb(*text_files).games)
+        black, white, result = sample_positions(games, args.sample, args.min_ply, args.seed)
+
+    total, by_stage = evaluate_positions(models, black, white, result, args.workers)
+    print("positions: {}".format(len(result)))
+    for i, path in enumerate(args.models):
+        stages = " ".join("{:.2f}".format(e) for e in by_stage[i])
+        print(f"Model Index:{i}, {path}, RMSE: {total[i]:.2f}, RMSE by stage (empties//9): {stages}")
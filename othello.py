@@ -5,9 +5,12 @@ import numpy as np
 from contextlib import contextmanager
 import sys
 import traceback
-from util import Hash, LRUCache
+from util import Hash, LRUCache, ArrayCache
+import bitboard
 
 class Board(object):
+    """Othello board backed by a pair of bitboards, see `bitboard`.
+    """
     BLANK = 0
     BLACK = 1
     WHITE = 2
@@ -22,24 +25,256 @@ class Board(object):
         else:
             return cls.BLACK
 
+    HASH_SEED = 20161
+
+    def __init__(self, size=8, cache_memory=None):
+        """With `cache_memory` (bytes) the move and terminal state caches
+        are `ArrayCache`s splitting that budget, instead of `LRUCache`s.
+        """
+        assert size == 8, "bitboards only support 8x8 boards"
+        self._size = size
+        # the same zobrist keys for every board, so hashes (and tables
+        # keyed by them) can be shared between boards
+        self._hash = Hash(seed=Board.HASH_SEED)
+        self.init_board()
+        if cache_memory is None:
+            self._feasible_pos_cache = LRUCache(900000)
+            self._board_state_cache = LRUCache(3500000)
+        else:
+            self._feasible_pos_cache = ArrayCache(cache_memory // 2, value_dtype=np.uint64)
+            self._board_state_cache = ArrayCache(cache_memory // 2, value_dtype=np.uint8)
+
+    def init_board(self):
+        self.set_bits(bitboard.INIT_BLACK, bitboard.INIT_WHITE)
+
+    def set_board(self, board):
+        self.set_bits(*bitboard.from_array(board))
+
+    def set_bits(self, black, white):
+        self._black = black
+        self._white = white
+        self._hash_value = self._hash.bits(black, white)
+        self._board = None
+        self._undo_stack = []
+
+    @property
+    def bits(self):
+        return self._black, self._white
+
+    @property
+    def hash(self):
+        """Zobrist hash of the position, maintained incrementally by
+        `flip`.
+        """
+        return self._hash_value
+
+    def _own_bits(self, player):
+        if player == Board.BLACK:
+            return self._black, self._white
+        else:
+            return self._white, self._black
+
+    def cache_status(self):
+        return self._feasible_pos_cache.size(), self._board_state_cache.size()
+
+    def cache_stats(self):
+        return {"feasible_pos": self._feasible_pos_cache.stats(),
+                "board_state": self._board_state_cache.stats()}
+
+    def moves_mask(self, player):
+        p, o = self._own_bits(player)
+        return bitboard.moves_mask(p, o)
+
+    def flip_mask(self, i, j, player):
+        p, o = self._own_bits(player)
+        return bitboard.flip_mask(i * 8 + j, p, o)
+
+    def feasible_pos(self, player, enable_cache=True):
+        # caches the moves as a bitboard, which fits either cache type
+        h = self._hash_value + player
+        m = None
+        if enable_cache:
+            m = self._feasible_pos_cache.get(h)
+        if m is None:
+            m = self.moves_mask(player)
+            self._feasible_pos_cache.put(h, m)
+
+        return [divmod(sq, 8) for sq in bitboard.squares(int(m))]
+
+    def is_terminal_state(self):
+        h = self._hash_value
+        terminal = self._board_state_cache.get(h)
+        if terminal is not None:
+            return bool(terminal)
+
+        terminal = (bitboard.moves_mask(self._black, self._white) == 0 and
+                    bitboard.moves_mask(self._white, self._black) == 0)
+        self._board_state_cache.put(h, terminal)
+        return terminal
+
+    def flip(self, i, j, player):
+        """Plays (i, j) in place, `undo` takes it back.
+        """
+        sq = i * 8 + j
+        p, o = self._own_bits(player)
+        assert not ((p | o) >> sq) & 1
+        f = bitboard.flip_mask(sq, p, o)
+        assert f != 0, "\n{}\n{}\n{}".format(self.board, (i,j), player)
+        self._apply(sq, player, f)
+        self._undo_stack.append((sq, player, f))
+
+    def _apply(self, sq, player, f):
+        # toggles the move in and out, it is its own inverse
+        if player == Board.BLACK:
+            self._black ^= f | (1 << sq)
+            self._white ^= f
+        else:
+            self._white ^= f | (1 << sq)
+            self._black ^= f
+        self._hash_value = self._hash.update(self._hash_value, sq, player - 1, f)
+        self._board = None
+
+    def undo(self):
+        """Takes back the last move played by `flip`.
+        """
+        self._apply(*self._undo_stack.pop())
+
+    @contextmanager
+    def flip2(self, i, j, player):
+        self.flip(i, j, player)
+        try:
+            yield self
+        finally:
+            self.undo()
+
+    def score(self, player):
+        if player == Board.BLACK:
+            return bitboard.popcount(self._black)
+        elif player == Board.WHITE:
+            return bitboard.popcount(self._white)
+        else:
+            return self.blanks
+
+
+    @classmethod
+    def _wins(cls, b, player):
+        s1 = np.sum(b == player)
+        s2 = np.sum(b == Board.opponent(player))
+        return s1 > s2
+
+    def wins(self, player):
+        s1 = self.score(player)
+        s2 = self.score(Board.opponent(player))
+        return s1 > s2
+
+    @property
+    def blanks(self):
+        return 64 - bitboard.popcount(self._black | self._white)
+
+    def __str__(self):
+        return str(self.board)
+
+    def __repr__(self):
+        return str(self.board)
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = bitboard.to_array(self._black, self._white).reshape(8, 8)
+        return self._board
+
+    @property
+    def size(self):
+        return self._size
+
+    def is_feasible(self, i, j, player):
+        sq = i * 8 + j
+        p, o = self._own_bits(player)
+        if ((p | o) >> sq) & 1:
+            return False
+        return bitboard.flip_mask(sq, p, o) != 0
+
+    def _is_valid_pos(self, i, j):
+        return (i < self._size and i >= 0 and j < self._size and j >= 0)
+
+    def _cmd_symbol(self, i, j):
+        if self.board[i][j] == Board.BLANK:
+            return '-'
+        elif self.board[i][j] == Board.BLACK:
+            return "*"
+        else:
+            return "o"
+
+    def print_for_player(self, player):
+        prt = sys.stdout.write
+
+        if player not in (Board.BLACK, Board.WHITE):
+            pos = []
+        else:
+            pos = self.feasible_pos(player)
+
+        rows, columns = self.board.shape
+        for i in range(0, rows):
+            for j in range(0, columns):
+                try:
+                    idx = pos.index((i,j))
+                    prt(chr(ord("A") + idx))
+                except:
+                    prt(self._cmd_symbol(i, j))
+                prt(" ")
+            prt("\n")
+        prt("\nBlack score: {0}, White score: {1}\n".format(self.score(Board.BLACK),
+                                                            self.score(Board.WHITE)))
+        sys.stdout.flush()
+
+class ArrayBoard(Board):
+    """The original numpy array board, kept as a reference engine to
+    cross-check `Board` against, see `database.check_board_parity`.
+    """
     def __init__(self, size=8):
         assert size % 2 == 0
         self._size = size
         self.init_board()
         self._feasible_pos_cache = LRUCache(900000)
         self._board_state_cache = LRUCache(3500000)
-        self._hash = Hash()
+        self._hash = Hash(seed=Board.HASH_SEED)
 
     def init_board(self):
-        self._board = np.zeros((self._size, self._size), dtype=np.int)
+        self._board = np.zeros((self._size, self._size), dtype=int)
         i = self._size // 2
         self._board[i-1][i-1] = Board.WHITE
         self._board[i-1][i] = Board.BLACK
         self._board[i][i] = Board.WHITE
         self._board[i][i-1] = Board.BLACK
+        self._undo_stack = []
 
     def set_board(self, board):
-        self._board = np.array(board, dtype=np.int)
+        self._board = np.array(board, dtype=int)
+        self._undo_stack = []
+
+    def set_bits(self, black, white):
+        self._board = bitboard.to_array(black, white).reshape(self._size, self._size)
+        self._undo_stack = []
+
+    @property
+    def bits(self):
+        return bitboard.from_array(self._board)
+
+    @property
+    def hash(self):
+        return self._hash(self._board)
+
+    def moves_mask(self, player):
+        m = 0
+        for i, j in self.feasible_pos(player, enable_cache=False):
+            m |= 1 << (i * 8 + j)
+        return m
+
+    def flip_mask(self, i, j, player):
+        before = self.bits
+        with self.flip2(i, j, player):
+            after = self.bits
+        return before[2 - player] & after[player - 1]
 
     def cache_status(self):
         return self._feasible_pos_cache.size(), self._board_state_cache.size()
@@ -88,7 +323,7 @@ class Board(object):
 
     def flip(self, i, j, player):
         assert self._board[i][j] == Board.BLANK
-        cnt = 0
+        flipped = []
         for di, dj in Board.DIRECTIONS:
             for d in range(1, self._size):
                 ii = i + di * d
@@ -100,33 +335,31 @@ class Board(object):
                 if self._board[ii][jj] == player:
                     for x in range(1, d):
                         self._board[i+di*x][j+dj*x] = player
-                        cnt += 1
+                        flipped.append((i+di*x, j+dj*x))
                     break
-        assert cnt > 0, "\n{}\n{}\n{}".format(self._board, (i,j), player)
+        assert len(flipped) > 0, "\n{}\n{}\n{}".format(self._board, (i,j), player)
         self._board[i][j] = player
+        self._undo_stack.append((i, j, player, flipped))
+
+    def undo(self):
+        i, j, player, flipped = self._undo_stack.pop()
+        opponent = Board.opponent(player)
+        for ii, jj in flipped:
+            self._board[ii][jj] = opponent
+        self._board[i][j] = Board.BLANK
 
     @contextmanager
     def flip2(self, i, j, player):
-        backup = self._board.copy()
         self.flip(i, j, player)
-        yield self
-        self._board = backup
+        try:
+            yield self
+        finally:
+            self.undo()
 
     def score(self, player):
         return np.sum(self._board == player)
 
 
-    @classmethod
-    def _wins(cls, b, player):
-        s1 = np.sum(b == player)
-        s2 = np.sum(b == Board.opponent(player))
-        return s1 > s2
-
-    def wins(self, player):
-        s1 = self.score(player)
-        s2 = self.score(Board.opponent(player))
-        return s1 > s2
-
     @property
     def blanks(self):
         return np.sum(self.board == Board.BLANK)
@@ -160,39 +393,6 @@ class Board(object):
                     break
         return cnt > 0
 
-    def _is_valid_pos(self, i, j):
-        return (i < self._size and i >= 0 and j < self._size and j >= 0)
-
-    def _cmd_symbol(self, i, j):
-        if self._board[i][j] == Board.BLANK:
-            return '-'
-        elif self._board[i][j] == Board.BLACK:
-            return "*"
-        else:
-            return "o"
-
-    def print_for_player(self, player):
-        prt = sys.stdout.write
-
-        if player not in (Board.BLACK, Board.WHITE):
-            pos = []
-        else:
-            pos = self.feasible_pos(player)
-
-        rows, columns = self.board.shape
-        for i in range(0, rows):
-            for j in range(0, columns):
-                try:
-                    idx = pos.index((i,j))
-                    prt(chr(ord("A") + idx))
-                except:
-                    prt(self._cmd_symbol(i, j))
-                prt(" ")
-            prt("\n")
-        prt("\nBlack score: {0}, White score: {1}\n".format(self.score(Board.BLACK),
-                                                            self.score(Board.WHITE)))
-        sys.stdout.flush()
-
 class Game(object):
     def __init__(self, black_player, white_player, verbose=0):
         assert black_player.role == Board.BLACK
@@ -202,13 +402,33 @@ class Game(object):
         self._black_wins = 0
         self._white_wins = 0
         self._ties = 0
+        self._moves = []
 
     def game_stat(self):
         return self._black_wins, self._white_wins, self._ties
 
-    def run(self):
+    @property
+    def players(self):
+        return self._players
+
+    @property
+    def moves(self):
+        """(player, row, column) of every move of the last game.
+        """
+        return self._moves
+
+    def run(self, opening=()):
+        """Plays a game from the position reached by the (player, row,
+        column) moves of `opening`, returns the final black and white
+        scores.
+        """
         board = Board()
         turn = 0
+        self._moves = []
+        for p, r, c in opening:
+            board.flip(r, c, p)
+            self._moves.append((p, r, c))
+            turn = 0 if p == Board.WHITE else 1
 
         for p in self._players:
             p.begin_of_game(board)
@@ -222,6 +442,7 @@ class Game(object):
                 try:
                     i,j = self._players[turn].play(board)
                     board.flip(i, j, self._players[turn].role)
+                    self._moves.append((self._players[turn].role, i, j))
                     idx = pos.index((i,j))
                     if self._verbose > 1:
                         print("player {0}: {1}".format(self._players[turn].role, chr(ord("A") + idx)))
@@ -252,3 +473,4 @@ class Game(object):
             self._white_wins += 1
         else:
             self._ties += 1
+        return black_score, white_score
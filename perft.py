@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Counts the leaf nodes of the game tree to a fixed depth.
+
+https://www.chessprogramming.org/Perft
+
+A pass consumes a ply, a finished game is a leaf whatever the depth
+left. The counts are the same for every engine, so they check a move
+generator against the others and time it.
+"""
+from __future__ import print_function
+
+import time
+
+import bitboard
+from othello import Board, ArrayBoard
+
+# from the initial position, by depth
+INITIAL_COUNTS = [1, 4, 12, 56, 244, 1396, 8200, 55092, 390216, 3005288, 24571284]
+
+
+def bits_perft(p, o, depth, bulk=True):
+    """Perft on raw bitboards, `p` to move. With `bulk` the moves at
+    depth 1 are counted instead of played.
+    """
+    if depth == 0:
+        return 1
+    moves = bitboard.moves_mask(p, o)
+    if not moves:
+        if not bitboard.moves_mask(o, p):
+            return 1
+        return bits_perft(o, p, depth-1, bulk)
+    if bulk and depth == 1:
+        return bitboard.popcount(moves)
+    n = 0
+    for sq in bitboard.squares(moves):
+        f = bitboard.flip_mask(sq, p, o)
+        n += bits_perft(o ^ f, p | f | (1 << sq), depth-1, bulk)
+    return n
+
+def board_perft(board, player, depth, bulk=True):
+    """Perft through the `Board` interface: `is_terminal_state`,
+    `feasible_pos` (uncached), `flip` and `undo`.
+    """
+    if depth == 0:
+        return 1
+    moves = board.feasible_pos(player, False)
+    if not moves:
+        if board.is_terminal_state():
+            return 1
+        return board_perft(board, Board.opponent(player), depth-1, bulk)
+    if bulk and depth == 1:
+        return len(moves)
+    n = 0
+    for i, j in moves:
+        board.flip(i, j, player)
+        try:
+            n += board_perft(board, Board.opponent(player), depth-1, bulk)
+        finally:
+            board.undo()
+    return n
+
+ENGINES = ["bitboard", "board", "array"]
+
+def perft(black, white, player, depth, engine="bitboard", bulk=True):
+    if engine == "bitboard":
+        if player == Board.BLACK:
+            return bits_perft(black, white, depth, bulk)
+        return bits_perft(white, black, depth, bulk)
+    if engine == "board":
+        b = Board()
+    elif engine == "array":
+        b = ArrayBoard()
+    else:
+        raise Exception("Unknown engine:{0}".format(engine))
+    b.set_bits(black, white)
+    return board_perft(b, player, depth, bulk)
+
+def divide(black, white, player, depth, engine="bitboard", bulk=True):
+    """(move, count) for each move at the root, ("pass", count) if
+    `player` has to pass.
+    """
+    p, o = (black, white) if player == Board.BLACK else (white, black)
+    moves = bitboard.moves_mask(p, o)
+    if depth == 0 or not moves:
+        return [("pass", perft(black, white, player, depth, engine, bulk))]
+    ret = []
+    for sq in bitboard.squares(moves):
+        f = bitboard.flip_mask(sq, p, o)
+        np_, no = p | f | (1 << sq), o ^ f
+        if player == Board.BLACK:
+            child = (np_, no)
+        else:
+            child = (no, np_)
+        ret.append((sq, perft(child[0], child[1], Board.opponent(player), depth-1, engine, bulk)))
+    return ret
+
+def square_name(sq):
+    if sq == "pass":
+        return sq
+    return "{0}{1}".format(chr(ord('a') + sq % 8), sq // 8 + 1)
+
+def parse_moves(moves):
+    """(black, white, player to move) after moves like "f5d6c3", column
+    letter then row number, passes are implied.
+    """
+    black, white = bitboard.INIT_BLACK, bitboard.INIT_WHITE
+    player = Board.BLACK
+    moves = moves.strip().lower()
+    for k in range(0, len(moves), 2):
+        sq = (int(moves[k+1]) - 1) * 8 + ord(moves[k]) - ord('a')
+        p, o = (black, white) if player == Board.BLACK else (white, black)
+        if not bitboard.moves_mask(p, o):
+            player = Board.opponent(player)
+            p, o = o, p
+        f = bitboard.flip_mask(sq, p, o)
+        if not f or (p | o) >> sq & 1:
+            raise Exception("Illegal move:{0}".format(moves[k:k+2]))
+        p, o = p | f | (1 << sq), o ^ f
+        black, white = (p, o) if player == Board.BLACK else (o, p)
+        player = Board.opponent(player)
+    p, o = (black, white) if player == Board.BLACK else (white, black)
+    if not bitboard.moves_mask(p, o) and bitboard.moves_mask(o, p):
+        player = Board.opponent(player)
+    return black, white, player
+
+def parse_board(cells, player):
+    """(black, white, player) from 64 cells of X (black), O (white) and
+    - (empty), row by row from a1.
+    """
+    cells = cells.strip().upper()
+    assert len(cells) == 64
+    black = sum(1 << sq for sq, c in enumerate(cells) if c in "XB*")
+    white = sum(1 << sq for sq, c in enumerate(cells) if c in "OW")
+    return black, white, Board.BLACK if player == "black" else Board.WHITE
+
+
+import argparse
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="perft.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("depth", type=int, help="perft depth")
+    parser.add_argument("--moves", default="", help="start after these moves, e.g. f5d6c3")
+    parser.add_argument("--board", help="start from 64 cells of X, O and -, row by row from a1")
+    parser.add_argument("--player", default="black", choices=["black", "white"], help="player to move with --board")
+    parser.add_argument("--engine", default="bitboard", choices=ENGINES, help="move generator")
+    parser.add_argument("--divide", action="store_true", help="count per root move")
+    parser.add_argument("--no-bulk", action="store_true", help="play the moves at depth 1 instead of counting them")
+    parser.add_argument("--check", action="store_true",
+                        help="cross-check all engines at every depth up to depth, and the known counts")
+    args = parser.parse_args()
+
+    if args.board is not None:
+        black, white, player = parse_board(args.board, args.player)
+    else:
+        black, white, player = parse_moves(args.moves)
+    bulk = not args.no_bulk
+
+    if args.check:
+        ok = True
+        for d in range(1, args.depth+1):
+            counts = []
+            for engine in ENGINES:
+                start = time.time()
+                counts.append(perft(black, white, player, d, engine, bulk))
+                print("depth {0} {1:>8}: {2} ({3:.2f}s)".format(d, engine, counts[-1], time.time() - start))
+            if len(set(counts)) != 1:
+                ok = False
+                print("MISMATCH at depth {0}".format(d))
+            if (not args.moves and args.board is None and d < len(INITIAL_COUNTS)
+                and counts[0] != INITIAL_COUNTS[d]):
+                ok = False
+                print("MISMATCH with the known count {0} at depth {1}".format(INITIAL_COUNTS[d], d))
+        print("OK" if ok else "FAILED")
+    elif args.divide:
+        total = 0
+        for sq, n in divide(black, white, player, args.depth, args.engine, bulk):
+            print("{0}: {1}".format(square_name(sq), n))
+            total += n
+        print("total: {0}".format(total))
+    else:
+        start = time.time()
+        n = perft(black, white, player, args.depth, args.engine, bulk)
+        elapsed = time.time() - start
+        print("perft({0}) = {1}, {2:.2f}s, {3:.0f} leaves/s".format(args.depth, n, elapsed, n / max(elapsed, 1e-9)))
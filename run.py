@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import json
+import multiprocessing as mp
+
 import numpy as np
 
 from othello import Board, Game
 from ai import HumanPlayer, Bot
 from value import ModelScorer, NaiveScorer
 from util import Config
+from database import TextDb, _move_to_str
+from book import OpeningBook
 
-def load_player(role, config):
-    if role == Board.BLACK:
-        section = "Black"
-    else:
-        section = "White"
+def load_player(role, config, section=None, collect_stats=False):
+    if section is None:
+        if role == Board.BLACK:
+            section = "Black"
+        else:
+            section = "White"
 
     player_type = config.get_as_str(section, "type")
     if player_type == "Bot":
@@ -23,43 +29,175 @@ def load_player(role, config):
         elif evaluator_type == "Model":
             evaluator = ModelScorer()
             evaluator.load(model)
-        depth = config.get_as_int(section, "depth", 1)
+        time_limit = config.get_as_float(section, "time")
+        if time_limit is None:
+            depth = config.get_as_int(section, "depth", 1)
+        else:
+            depth = config.get_as_int(section, "depth")
         final_depth = config.get_as_int(section, "final_depth", 3)
-        player = Bot(evaluator, depth, final_depth, role)
+        book = config.get_as_str(section, "book")
+        if book is not None:
+            book = OpeningBook(book, config.get_as_int(section, "book_min_games", 10))
+        batch = config.get_as_boolean(section, "batch", False)
+        workers = config.get_as_int(section, "workers", 1)
+        search = config.get_as_str(section, "search", "alphabeta")
+        player = Bot(evaluator, depth, final_depth, role, time_limit=time_limit, book=book,
+                     batch=batch, workers=workers, search=search, collect_stats=collect_stats)
     elif player_type == "Human":
         player = HumanPlayer(role)
     else:
         raise Exception("Unknown player type:{0}".format(player_type))
     return player
 
-def tell_game_stat(game):
-    b,w,t = game.game_stat()
+def _tell_stat(b, w, t, first="black", second="white"):
     num_of_games = b + w + t
-    info_template = "total games: {}, black wins: {} {}, white wins: {} {}, ties: {}"
+    info_template = "total games: {}, {} wins: {} {}, {} wins: {} {}, ties: {}"
     print(info_template.format(num_of_games,
+                               first,
                                b,
                                1.*b/num_of_games,
+                               second,
                                w,
                                1.*w/num_of_games,
                                t))
 
-def play(games, verbose, player_config):
-    black_player = load_player(Board.BLACK, player_config)
-    white_player = load_player(Board.WHITE, player_config)
+def tell_game_stat(game):
+    _tell_stat(*game.game_stat())
+
+def _game_stats(players):
+    return [getattr(p, "game_stats", []) for p in players]
+
+def _write_stats(f, game, stats):
+    """Writes the per move stats of the bots as JSON lines.
+    """
+    for role, moves in zip(("black", "white"), stats):
+        for ply, s in enumerate(moves):
+            f.write(json.dumps(dict(s, game=game, role=role, move_index=ply)) + "\n")
+
+def play(games, verbose, player_config, stats_file=None):
+    collect_stats = stats_file is not None
+    black_player = load_player(Board.BLACK, player_config, collect_stats=collect_stats)
+    white_player = load_player(Board.WHITE, player_config, collect_stats=collect_stats)
     game = Game(black_player, white_player, verbose)
-    for i in range(1, games+1):
-        game.run()
-        if i % 100 == 0 and i > 0:
-            tell_game_stat(game)
+    stats = open(stats_file, "w") if stats_file is not None else None
+    try:
+        for i in range(1, games+1):
+            game.run()
+            if stats is not None:
+                _write_stats(stats, i, _game_stats((black_player, white_player)))
+            if i % 100 == 0 and i > 0:
+                tell_game_stat(game)
+    finally:
+        black_player.close()
+        white_player.close()
+        if stats is not None:
+            stats.close()
     tell_game_stat(game)
 
 
+def load_openings(files, plies):
+    """Distinct first `plies` moves of the games in text databases.
+    """
+    openings = []
+    seen = set()
+    for moves, _ in TextDb(*files).games:
+        if len(moves) < plies:
+            continue
+        o = tuple(moves[:plies])
+        if o not in seen:
+            seen.add(o)
+            openings.append(o)
+    return openings
+
+_worker_games = None
+
+def _init_worker(conf, verbose, collect_stats):
+    global _worker_games
+    config = Config(conf)
+    # the players of the [Black] and [White] sections, with colors as
+    # configured and swapped
+    _worker_games = [Game(load_player(Board.BLACK, config, collect_stats=collect_stats),
+                          load_player(Board.WHITE, config, collect_stats=collect_stats),
+                          verbose),
+                     Game(load_player(Board.BLACK, config, "White", collect_stats),
+                          load_player(Board.WHITE, config, "Black", collect_stats),
+                          verbose)]
+
+def _run_game(task):
+    swapped, opening = task
+    game = _worker_games[swapped]
+    black_score, white_score = game.run(opening)
+    return swapped, black_score, white_score, list(game.moves), _game_stats(game.players)
+
+def play_parallel(games, verbose, conf, workers, swap=False, openings=None, log_file=None,
+                  stats_file=None):
+    """Plays `games` games over `workers` processes. With `swap` games
+    come in pairs with the colors of the two configured players swapped,
+    with `openings` game pairs start from the given openings in turn.
+    """
+    tasks = []
+    for i in range(games):
+        if swap:
+            swapped, k = i % 2, i // 2
+        else:
+            swapped, k = 0, i
+        if openings:
+            opening = openings[k % len(openings)]
+        else:
+            opening = ()
+        tasks.append((swapped, opening))
+
+    by_color = [0, 0, 0]
+    by_player = [0, 0, 0]
+    log = open(log_file, "w") if log_file is not None else None
+    # a pool keeps respawning workers whose initializer raises, so a bad
+    # config has to fail here
+    config = Config(conf)
+    for role in (Board.BLACK, Board.WHITE):
+        load_player(role, config).close()
+
+    stats = open(stats_file, "w") if stats_file is not None else None
+    pool = mp.Pool(workers, initializer=_init_worker, initargs=(conf, verbose, stats is not None))
+    try:
+        for n, (swapped, b, w, moves, move_stats) in enumerate(pool.imap_unordered(_run_game, tasks), 1):
+            if b > w:
+                by_color[0] += 1
+                by_player[swapped] += 1
+            elif w > b:
+                by_color[1] += 1
+                by_player[1 - swapped] += 1
+            else:
+                by_color[2] += 1
+                by_player[2] += 1
+            if log is not None:
+                log.write("{0}:{1}\n".format(''.join(map(_move_to_str, moves)), b - w))
+            if stats is not None:
+                _write_stats(stats, n, move_stats)
+            if n % 100 == 0 or n == games:
+                _tell_stat(*by_color)
+                _tell_stat(*by_player, first="[Black] player", second="[White] player")
+    finally:
+        pool.close()
+        pool.join()
+        if log is not None:
+            log.close()
+        if stats is not None:
+            stats.close()
+    return by_color, by_player
+
+
 import argparse
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog="run.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--conf", default="./config/config.ini", help="player config")
     parser.add_argument("--verbose", default=1, type=int, help="verbose level")
     parser.add_argument("--games", default=100, type=int, help="number of games to play")
+    parser.add_argument("--workers", default=0, type=int, help="play games over this many processes")
+    parser.add_argument("--swap", action="store_true", help="play game pairs with colors swapped (with --workers)")
+    parser.add_argument("--openings", nargs="*", help="text databases to take openings from (with --workers)")
+    parser.add_argument("--opening-plies", default=8, type=int, help="number of opening moves")
+    parser.add_argument("--log", help="write the moves of every game to this file (with --workers)")
+    parser.add_argument("--stats", help="write the search stats of every bot move to this file as JSON lines")
 
     args = parser.parse_args()
     player_config = Config(args.conf)
@@ -70,4 +208,11 @@ if __name__ == '__main__':
     player_config.print_config()
     print('-' * 70)
 
-    play(args.games, args.verbose, player_config)
+    if args.workers > 0:
+        openings = None
+        if args.openings:
+            openings = load_openings(args.openings, args.opening_plies)
+        play_parallel(args.games, args.verbose, args.conf, args.workers,
+                      args.swap, openings, args.log, args.stats)
+    else:
+        play(args.games, args.verbose, player_config, args.stats)
@@ -1,55 +1,160 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import multiprocessing as mp
+import time
+
+import numpy as np
 
 from othello import Board
 from util import epsilon_greedy
 from value import ModelScorer
-from ai import Bot
+from ai import Bot, TranspositionTable
+
+def _self_play_game(b, black_bot, white_bot, model, eplison, learn):
+    """Plays one game on `b`, calling `learn(b, v)` with the TD target of
+    every position a move is chosen in.
+    """
+    b.init_board()
+    p = Board.BLACK
+
+    while not b.is_terminal_state():
+        options = b.feasible_pos(p)
+        vals = []
+
+        if len(options) > 0:
+            if p == Board.BLACK:
+                gr, (ga0, ga1) = black_bot._play(b)
+            else:
+                gr, (ga0, ga1) = white_bot._play(b)
+                gr = -gr
+            for i,j in options:
+                with b.flip2(i, j, p):
+                    if b.is_terminal_state():
+                        vals.append(b.score(Board.BLACK) - b.score(Board.WHITE))
+                    else:
+                        vals.append(model(b))
+            (a0, a1), v = epsilon_greedy(eplison, options, vals, (ga0, ga1), gr)
+            learn(b, v)
+            b.flip(a0, a1, p)
+
+        p = Board.opponent(p)
 
 def self_play(n, model):
     b = Board()
-    black_bot = Bot(model, 3, 6, Board.BLACK)
-    white_bot = Bot(model, 3, 6, Board.WHITE)
+    table = TranspositionTable()
+    black_bot = Bot(model, 3, 6, Board.BLACK, table)
+    white_bot = Bot(model, 3, 6, Board.WHITE, table)
     eplison = 0.05
 
+    def learn(b, v):
+        model.update(b, v)
+        # the stored values are those of the old weights
+        table.invalidate()
+
+    start = time.time()
     for t in range(1, n+1):
-        b.init_board()
-        p = Board.BLACK
-
-        while not b.is_terminal_state():
-            options = b.feasible_pos(p)
-            vals = []
-
-            if len(options) > 0:
-                if p == Board.BLACK:
-                    gr, (ga0, ga1) = black_bot._play(b)
-                else:
-                    gr, (ga0, ga1) = white_bot._play(b)
-                    gr = -gr
-                for i,j in options:
-                    with b.flip2(i, j, p):
-                        if b.is_terminal_state():
-                            vals.append(b.score(Board.BLACK) - b.score(Board.WHITE))
-                        else:
-                            vals.append(model(b))
-                (a0, a1), v = epsilon_greedy(eplison, options, vals, (ga0, ga1), gr)
-                model.update(b, v)
-                b.flip(a0, a1, p)
-
-            p = Board.opponent(p)
+        _self_play_game(b, black_bot, white_bot, model, eplison, learn)
 
         if t % 100 == 0:
-            logging.info("Number of games played: {}".format(t))
+            logging.info("Number of games played: {}, games/s: {:.2f}".format(t, t / (time.time() - start)))
             model.save("./model/model.cpt.npy")
 
     model.save("./model/model.cpt.npy")
 
 
+def _self_play_worker(seed, weights, version, lock, trajectories, stop):
+    """Plays games with the latest published weights and sends back
+    the (black, white, target) positions of each game.
+    """
+    np.random.seed(seed)
+    model = ModelScorer()
+    shared = np.frombuffer(weights, dtype=np.float64).reshape(model.weights.shape)
+    b = Board()
+    table = TranspositionTable()
+    black_bot = Bot(model, 3, 6, Board.BLACK, table)
+    white_bot = Bot(model, 3, 6, Board.WHITE, table)
+    eplison = 0.05
+
+    current = -1
+    while not stop.is_set():
+        if version.value != current:
+            with lock:
+                model.set_weights(shared)
+                current = version.value
+                table.invalidate()
+        game = []
+        _self_play_game(b, black_bot, white_bot, model, eplison,
+                        lambda b, v: game.append(b.bits + (v,)))
+        trajectories.put(game)
+    trajectories.put(None)
+
+def parallel_self_play(n, model, workers, sync_interval=10):
+    """`workers` processes generate self-play games while this process
+    applies the TD updates, publishing the weights to the workers through
+    shared memory every `sync_interval` games.
+    """
+    shape = model.weights.shape
+    weights = mp.RawArray('d', int(np.prod(shape)))
+    shared = np.frombuffer(weights, dtype=np.float64).reshape(shape)
+    shared[:] = model.weights
+    version = mp.RawValue('l', 0)
+    lock = mp.Lock()
+    trajectories = mp.Queue()
+    stop = mp.Event()
+
+    procs = [mp.Process(target=_self_play_worker,
+                        args=(np.random.randint(1<<31), weights, version, lock, trajectories, stop))
+             for _ in range(workers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    b = Board()
+    t = 0
+    running = workers
+    start = time.time()
+    while running > 0:
+        game = trajectories.get()
+        if game is None:
+            running -= 1
+            continue
+        if t >= n:
+            continue
+        for black, white, v in game:
+            b.set_bits(black, white)
+            model.update(b, v)
+        t += 1
+
+        if t % sync_interval == 0:
+            with lock:
+                shared[:] = model.weights
+                version.value += 1
+        if t % 100 == 0:
+            logging.info("Number of games played: {}, games/s: {:.2f}".format(t, t / (time.time() - start)))
+            model.save("./model/model.cpt.npy")
+        if t == n:
+            stop.set()
+
+    for proc in procs:
+        proc.join()
+    model.save("./model/model.cpt.npy")
+
+
+import argparse
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="tdl.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--games", default=700000, type=int, help="number of self-play games")
+    parser.add_argument("--workers", default=0, type=int, help="self-play processes, 0 to play and learn in this process")
+    parser.add_argument("--sync-interval", default=10, type=int, help="games between weight broadcasts to the workers")
+    args = parser.parse_args()
+
     logging.basicConfig(filename='tdl.log',level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
 
     model = ModelScorer(learning_rate=0.001, gamma=0.01)
     model.load("./model/model.cpt.npy.6")
 
-    self_play(700000, model)
+    if args.workers > 0:
+        parallel_self_play(args.games, model, args.workers, args.sync_interval)
+    else:
+        self_play(args.games, model)
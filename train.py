@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import itertools
+import logging
+import time
+
+import numpy as np
+
+import bitboard
+from database import ThorDb, TextDb, _game_positions
+from value import ModelScorer
+
+def load_positions(databases, positions_file=None, min_ply=10):
+    """(black, white, result, game) arrays of the positions past the
+    first `min_ply` moves of the games of the databases, or read from a
+    positions file written by `save_db_as_binary`.
+    """
+    if positions_file is not None:
+        p = np.load(positions_file, mmap_mode="r")
+        p = p[p["ply"] > min_ply]
+        return (np.array(p["black"]), np.array(p["white"]),
+                np.array(p["result"], dtype=np.float64), np.array(p["game"], dtype=np.int64))
+
+    thor_files = [f for f in databases if f.lower().endswith((".wtb", ".zip"))]
+    text_files = [f for f in databases if not f.lower().endswith((".wtb", ".zip"))]
+    games = itertools.chain(ThorDb(*thor_files, stream=True).games, TextDb(*text_files).games)
+    black, white, result, game = [], [], [], []
+    for n, (moves, r) in enumerate(games):
+        for b, w, _, ply in _game_positions(moves):
+            if ply > min_ply:
+                black.append(b)
+                white.append(w)
+                result.append(r)
+                game.append(n)
+    return (np.array(black, dtype=np.uint64), np.array(white, dtype=np.uint64),
+            np.array(result, dtype=np.float64), np.array(game, dtype=np.int64))
+
+def loss(model, black, white, result, batch_size=4096):
+    """Mean squared error of `model` on the positions.
+    """
+    s = 0.0
+    for k in range(0, len(result), batch_size):
+        boards = bitboard.to_array(black[k:k+batch_size], white[k:k+batch_size])
+        err = model.evaluate_many(boards) - result[k:k+batch_size]
+        s += np.sum(err * err)
+    return s / max(1, len(result))
+
+def train(model, black, white, result, game, epochs=10, batch_size=256, validation=0.1, seed=None):
+    """Fits `model` to the final results of the positions with minibatch
+    updates, positions are shuffled every epoch. Games are split so that
+    a `validation` fraction of them is held out, the loss on those is
+    reported after each epoch.
+    """
+    rng = np.random.RandomState(seed)
+    games = np.unique(game)
+    held_out = np.zeros(len(result), dtype=bool)
+    if validation > 0:
+        held_out = np.isin(game, rng.choice(games, int(len(games) * validation), replace=False))
+    train_idx = np.flatnonzero(~held_out)
+    test_idx = np.flatnonzero(held_out)
+    logging.info("positions for training: {}, held out: {}".format(len(train_idx), len(test_idx)))
+
+    for epoch in range(1, epochs+1):
+        start = time.time()
+        rng.shuffle(train_idx)
+        s = 0.0
+        for k in range(0, len(train_idx), batch_size):
+            i = train_idx[k:k+batch_size]
+            s += model.update_many(bitboard.to_array(black[i], white[i]), result[i]) * len(i)
+        train_loss = s / max(1, len(train_idx))
+        if len(test_idx) > 0:
+            test_loss = loss(model, black[test_idx], white[test_idx], result[test_idx])
+        else:
+            test_loss = float("nan")
+        logging.info("epoch: {}, training loss: {:.2f}, held out loss: {:.2f}, positions/s: {:.0f}".format(
+            epoch, train_loss, test_loss, len(train_idx) / (time.time() - start)))
+    return model
+
+
+import argparse
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="train.py", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--positions", help="positions file written by database.py --positions")
+    parser.add_argument("--min-ply", default=10, type=int, help="skip positions of the first moves")
+    parser.add_argument("--epochs", default=10, type=int, help="passes over the training positions")
+    parser.add_argument("--batch-size", default=256, type=int, help="positions per update")
+    parser.add_argument("--learning-rate", default=0.001, type=float, help="learning rate")
+    parser.add_argument("--gamma", default=0.001, type=float, help="L2 regularization")
+    parser.add_argument("--optimizer", default="sgd", choices=["sgd", "adadelta"], help="optimizer")
+    parser.add_argument("--validation", default=0.1, type=float, help="fraction of games held out")
+    parser.add_argument("--seed", default=None, type=int, help="random seed")
+    parser.add_argument("--init", help="start from this model")
+    parser.add_argument("--output", default="./model/model.cpt.npy", help="model file")
+    parser.add_argument("databases", nargs="*", help="WTHOR (.wtb or .zip) or text databases")
+    args = parser.parse_args()
+
+    model = ModelScorer(learning_rate=args.learning_rate, gamma=args.gamma, optimizer=args.optimizer)
+    if args.init is not None:
+        model.load(args.init)
+    positions = load_positions(args.databases, args.positions, args.min_ply)
+    train(model, *positions, epochs=args.epochs, batch_size=args.batch_size,
+          validation=args.validation, seed=args.seed)
+    model.save(args.output)
@@ -19,6 +19,9 @@ class LRUCache(object):
     def __init__(self, capacity):
         self._cache = collections.OrderedDict()
         self._capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def contains(self, key):
         return key in self._cache
@@ -26,12 +29,19 @@ class LRUCache(object):
     def size(self):
         return len(self._cache)
 
+    def stats(self):
+        return {"size": len(self._cache), "capacity": self._capacity,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
     def get(self, key, default_val = None):
         try:
             v = self._cache.pop(key)
             self._cache[key] = v
+            self.hits += 1
         except:
             v = default_val
+            self.misses += 1
         return v
 
     def put(self, key, value):
@@ -40,17 +50,94 @@ class LRUCache(object):
         except:
             if len(self._cache) > self._capacity:
                 self._cache.popitem(last=False)
+                self.evictions += 1
         self._cache[key] = value
 
+class ArrayCache(object):
+    """Set associative cache in preallocated numpy arrays, sized by a
+    memory budget in bytes.
+
+    Keys are non-negative integers below 2**64 (e.g. zobrist hashes),
+    values have a fixed shape and dtype. Each key maps to one set of
+    `ways` slots, the least recently used slot of a full set is evicted.
+    Array values are returned as views, valid until the next `put`.
+    """
+    def __init__(self, memory, value_shape=(), value_dtype=np.int64, ways=4):
+        value_bytes = np.dtype(value_dtype).itemsize * int(np.prod(value_shape))
+        entry_bytes = 8 + 8 + value_bytes
+        self._sets = max(1, memory // (entry_bytes * ways))
+        self._ways = ways
+        self._keys = np.zeros((self._sets, ways), dtype=np.uint64)
+        self._values = np.zeros((self._sets, ways) + tuple(value_shape), dtype=value_dtype)
+        # last access time, 0 for an empty slot
+        self._ages = np.zeros((self._sets, ways), dtype=np.uint64)
+        self._clock = 0
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self):
+        return self._sets * self._ways
+
+    def size(self):
+        return self._size
+
+    def stats(self):
+        return {"size": self._size, "capacity": self.capacity,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def _find(self, key):
+        # plain python over the few ways beats numpy's per call overhead
+        s = key % self._sets
+        keys = self._keys[s].tolist()
+        for w in range(self._ways):
+            if keys[w] == key and self._ages[s, w]:
+                return s, w
+        return s, None
+
+    def contains(self, key):
+        return self._find(key)[1] is not None
+
+    def get(self, key, default_val = None):
+        s, w = self._find(key)
+        if w is None:
+            self.misses += 1
+            return default_val
+        self.hits += 1
+        self._clock += 1
+        self._ages[s, w] = self._clock
+        return self._values[s, w]
+
+    def put(self, key, value):
+        s, w = self._find(key)
+        if w is None:
+            ages = self._ages[s].tolist()
+            w = ages.index(min(ages))
+            if ages[w] > 0:
+                self.evictions += 1
+            else:
+                self._size += 1
+            self._keys[s, w] = key
+        self._clock += 1
+        self._ages[s, w] = self._clock
+        self._values[s, w] = value
+
+
 class Hash(object):
-    def __init__(self, positions=64, pieces=2, filename=None):
+    def __init__(self, positions=64, pieces=2, filename=None, seed=None):
         self._positions = positions
         self._pieces = pieces
         if filename is None:
-            self._table = np.random.randint(0, 2<<60, (positions, pieces))
+            rng = np.random.RandomState(seed)
+            self._table = rng.randint(0, 2<<60, (positions, pieces))
         else:
             self._table = np.load(filename)
             assert (positions, pieces) == self._table.shape
+        self._keys = self._table.tolist()
+        self._swap_keys = [k[0] ^ k[-1] for k in self._keys]
 
     def save(self, filename):
         np.save(filename, self._table)
@@ -65,6 +152,29 @@ class Hash(object):
                 h ^= self._table[i][v-1]
         return h
 
+    def bits(self, *pieces):
+        """Same hash as `__call__` for a position given as one bitboard
+        per piece type.
+        """
+        h = 0
+        for k, mask in enumerate(pieces):
+            while mask:
+                low = mask & -mask
+                h ^= self._keys[low.bit_length() - 1][k]
+                mask ^= low
+        return h
+
+    def update(self, h, pos, piece, flipped):
+        """Incrementally updates `h` for a `piece` (0 based) put at `pos`
+        that turns over the two piece types on the `flipped` bitboard.
+        """
+        h ^= self._keys[pos][piece]
+        while flipped:
+            low = flipped & -flipped
+            h ^= self._swap_keys[low.bit_length() - 1]
+            flipped ^= low
+        return h
+
 
 class Config(object):
     def __init__(self, filename):
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 from othello import Board
-from util import Hash, LRUCache
+from util import LRUCache, ArrayCache
 import numpy as np
 
 class Scorer(object):
     def __call__(self, board):
         return 0.0
 
+    def evaluate_many(self, boards):
+        """Scores N positions given as an (N, 8, 8) or (N, 64) array of
+        cells.
+        """
+        return np.zeros(len(boards))
+
     def update(self, xs, ys):
         pass
 
@@ -37,7 +43,23 @@ def _m7(r, c):
 _m = [ _m0, _m1, _m2, _m3, _m4, _m5, _m6, _m7 ]
 
 class ModelScorer(Scorer):
-    def __init__(self, path=None, learning_rate=0.01, gamma=0.001, optimizer="sgd"):
+    # rows at least this wide are updated sparsely unless told otherwise,
+    # about where sparse adadelta updates get faster (bench.py --suites update)
+    SPARSE_MIN_WEIGHTS = 8192
+
+    def __init__(self, path=None, learning_rate=0.01, gamma=0.001, optimizer="sgd", sparse=None,
+                 cache_memory=None):
+        """With `sparse` an update only touches the weights active in the
+        position, the L2 decay of the others is applied lazily when they
+        are next read or updated. That is exact for sgd, for adadelta the
+        squared gradient of a skipped weight is decayed as if the weight
+        stayed constant over the skipped updates. By default it is used
+        for networks with at least SPARSE_MIN_WEIGHTS weights per stage,
+        smaller rows are faster to update densely.
+
+        With `cache_memory` (bytes) features are cached in an
+        `ArrayCache` instead of an `LRUCache`.
+        """
         directions = [(0, 1), (1, 1)]
         corners = []
         num_of_weights = 0
@@ -58,13 +80,39 @@ class ModelScorer(Scorer):
                                   num_of_weights * 9])
         self._patterns = list(zip(directions, corners))
 
+        # a position is described by the weight indices active in it: for
+        # the k-th (pattern, symmetry) pair at squares sq0[k] and sq1[k]
+        # that is base[k] + 3 * cell(sq0[k]) + cell(sq1[k])
+        sq0, sq1, base = [], [], []
+        idx = 0
+        for (x, y), corners in self._patterns:
+            for r, c in corners:
+                for m in _m:
+                    r0,c0 = m(r,c)
+                    r1,c1 = m(r+x, c+y)
+                    sq0.append(r0 * 8 + c0)
+                    sq1.append(r1 * 8 + c1)
+                    base.append(idx * 9)
+                idx += 1
+        self._sq0 = np.array(sq0)
+        if num_of_weights * 9 < (1 << 15):
+            self._index_dtype = np.int16
+        else:
+            self._index_dtype = np.int32
+        self._sq1 = np.array(sq1)
+        self._base = np.array(base)
+
         self._learning_rate = learning_rate
         self._gamma = gamma
 
-        self._hash = Hash()
-        self._feature_cache = LRUCache(900000)
+        if cache_memory is None:
+            self._feature_cache = LRUCache(900000)
+        else:
+            self._feature_cache = ArrayCache(cache_memory, value_shape=self._sq0.shape,
+                                             value_dtype=self._index_dtype)
 
         self._update_count = 0
+        self.evaluations = 0
         self._squared_gradient = np.zeros([self._num_of_stages(),
                                            num_of_weights * 9])
         self._gradient_decay = 0.9
@@ -72,6 +120,15 @@ class ModelScorer(Scorer):
 
         self._optimizer = optimizer
 
+        # per stage number of sparse updates, and the update each weight
+        # has been decayed up to
+        if sparse is None:
+            sparse = num_of_weights * 9 >= ModelScorer.SPARSE_MIN_WEIGHTS
+        self._sparse = sparse
+        self._steps = np.zeros(self._num_of_stages(), dtype=np.int64)
+        self._last = np.zeros(self._weights.shape, dtype=np.int64)
+        self._lazy = False
+
         if path is not None:
             self.load(path)
 
@@ -81,40 +138,144 @@ class ModelScorer(Scorer):
     def _num_of_stages(self):
         return 60 // 9 + 1
 
-    def _feature_extract(self, b):
-        h = self._hash(b)
-        if self._feature_cache.contains(h):
-            return self._feature_cache.get(h)
-        _, sz = self._weights.shape
-        feature = np.zeros(sz)
-        idx = 0
-        for (x, y), corners in self._patterns:
-            for r, c in corners:
-                for m in _m:
-                    r0,c0 = m(r,c)
-                    r1,c1 = m(r+x, c+y)
-                    v0 = b[r0][c0]
-                    v1 = b[r1][c1]
-                    feature[v0*3 + v1 + idx * 9] += 1.0
-                idx += 1
-        self._feature_cache.put(h, feature)
-        return feature
+    def _indices(self, b):
+        """Active weight indices of (..., 64) arrays of cells.
+        """
+        return self._base + 3 * b[..., self._sq0] + b[..., self._sq1]
+
+    def _feature_extract(self, board):
+        h = board.hash
+        idx = self._feature_cache.get(h)
+        if idx is not None:
+            return idx
+        idx = self._indices(board.board.reshape(64)).astype(self._index_dtype)
+        self._feature_cache.put(h, idx)
+        return idx
+
+    def stats(self):
+        return {"evaluations": self.evaluations,
+                "feature_cache": self._feature_cache.stats()}
 
     def __call__(self, board):
-        feature = self._feature_extract(board.board)
+        self.evaluations += 1
+        idx = self._feature_extract(board)
         stage = self._stage(board)
-        w = self._weights[stage]
-        v = np.inner(feature, w)
-        assert not (np.isnan(v) or np.isinf(v)), "\n{}\n{}".format(feature, self._weights)
+        if self._lazy:
+            self._catch_up(stage, idx)
+        v = self._weights[stage][idx].sum()
+        assert not (np.isnan(v) or np.isinf(v)), "\n{}\n{}".format(idx, self._weights)
         return v
 
+    def evaluate_many(self, boards):
+        if self._lazy:
+            self.flush()
+        b = np.asarray(boards).reshape(-1, 64)
+        self.evaluations += len(b)
+        _, sz = self._weights.shape
+        stage = np.sum(b == Board.BLANK, axis=1) // 9
+        idx = self._indices(b)
+        idx += (stage * sz)[:, None]
+        return self._weights.reshape(-1)[idx].sum(axis=1)
+
+    def update_many(self, boards, ys):
+        """One minibatch step on the mean squared error of N positions
+        given as in `evaluate_many` against targets `ys`, returns the
+        mean squared error before the step.
+        """
+        if self._lazy:
+            self.flush()
+        b = np.asarray(boards).reshape(-1, 64)
+        n = len(b)
+        stages, sz = self._weights.shape
+        stage = np.sum(b == Board.BLANK, axis=1) // 9
+        idx = self._indices(b) + (stage * sz)[:, None]
+        w = self._weights.reshape(-1)
+        err = w[idx].sum(axis=1) - ys
+
+        gradient = np.bincount(idx.reshape(-1), weights=np.repeat(err, idx.shape[1]),
+                               minlength=stages * sz) / n
+        gradient += self._gamma * w
+        if self._optimizer == "sgd":
+            w -= self._learning_rate * gradient
+        elif self._optimizer == "adadelta":
+            g = self._squared_gradient.reshape(-1)
+            np.add(self._gradient_decay * g,
+                   (1.0-self._gradient_decay) * gradient * gradient,
+                   g)
+            w -= (self._learning_rate * gradient / np.sqrt(g + self._epsilon))
+        self._update_count += 1
+        return np.mean(err * err)
+
     def _value(self, feature, stage):
         w = self._weights[stage]
         v = np.inner(feature, w)
         return v
 
+    def _catch_up(self, stage, idx):
+        """Applies the L2 decay the weights at `idx` missed.
+        """
+        last = self._last[stage]
+        t = self._steps[stage]
+        k = t - last[idx]
+        if not k.any():
+            return
+        w = self._weights[stage]
+        wi = w[idx]
+        if self._optimizer == "sgd":
+            w[idx] = wi * (1.0 - self._learning_rate * self._gamma) ** k
+        elif self._optimizer == "adadelta":
+            g = self._squared_gradient[stage]
+            decay = self._gradient_decay ** k
+            gi = decay * g[idx] + (1.0 - decay) * (self._gamma * wi) ** 2
+            g[idx] = gi
+            w[idx] = wi * (1.0 - self._learning_rate * self._gamma / np.sqrt(gi + self._epsilon)) ** k
+        last[idx] = t
+
+    def flush(self):
+        """Brings every weight up to date with the lazy L2 decay.
+        """
+        _, sz = self._weights.shape
+        idx = np.arange(sz)
+        for stage in range(self._num_of_stages()):
+            self._catch_up(stage, idx)
+        self._lazy = False
+
     def update(self, board, y):
-        feature = self._feature_extract(board.board)
+        if self._sparse:
+            self._sparse_update(board, y)
+        else:
+            self._dense_update(board, y)
+        self._update_count += 1
+
+    def _sparse_update(self, board, y):
+        stage = self._stage(board)
+        _, sz = self._weights.shape
+        cnt = np.bincount(self._feature_extract(board), minlength=sz)
+        idx = cnt.nonzero()[0]
+        cnt = cnt[idx]
+        self._catch_up(stage, idx)
+        w = self._weights[stage]
+        wi = w[idx]
+        predict = np.inner(wi, cnt)
+
+        gradient = (predict - y) * cnt + self._gamma * wi
+        if self._optimizer == "sgd":
+            w[idx] = wi - self._learning_rate * gradient
+        elif self._optimizer == "adadelta":
+            g = self._squared_gradient[stage]
+            gi = (self._gradient_decay * g[idx] +
+                  (1.0-self._gradient_decay) * gradient * gradient)
+            g[idx] = gi
+            w[idx] = wi - self._learning_rate * gradient / np.sqrt(gi + self._epsilon)
+        self._steps[stage] += 1
+        self._last[stage, idx] = self._steps[stage]
+        self._lazy = True
+
+    def _dense_update(self, board, y):
+        if self._lazy:
+            self.flush()
+        _, sz = self._weights.shape
+        feature = np.bincount(self._feature_extract(board), minlength=sz)
         stage = self._stage(board)
         predict = self._value(feature, stage)
         w = self._weights[stage]
@@ -128,7 +289,20 @@ class ModelScorer(Scorer):
                    (1.0-self._gradient_decay) * gradient * gradient,
                    g)
             w -= (self._learning_rate * gradient / np.sqrt(g + self._epsilon))
-        self._update_count += 1
+
+    @property
+    def weights(self):
+        if self._lazy:
+            self.flush()
+        return self._weights
+
+    def set_weights(self, w):
+        """Copies `w` into the weights, e.g. a snapshot from another
+        process.
+        """
+        self._weights[:] = w
+        self._last[:] = self._steps[:, None]
+        self._lazy = False
 
     def load(self, path):
         w = np.load(path)
@@ -138,8 +312,12 @@ class ModelScorer(Scorer):
         else:
             self._weights = np.repeat(w.reshape([1, c]), r, axis=0)
         assert r,c == self._weights.shape
+        self._last[:] = self._steps[:, None]
+        self._lazy = False
 
     def save(self, path):
+        if self._lazy:
+            self.flush()
         np.save(path, self._weights)
 
 class NaiveScorer(Scorer):
@@ -170,10 +348,18 @@ class NaiveScorer(Scorer):
     def __call__(self, board):
         return np.sum(self._w * (board.board == Board.BLACK))
 
+    def evaluate_many(self, boards):
+        b = np.asarray(boards).reshape(-1, 64)
+        return np.dot(b == Board.BLACK, self._w.reshape(64))
+
 class CountScorer(Scorer):
     def __call__(self, board):
         return board.score(Board.BLACK)
 
+    def evaluate_many(self, boards):
+        b = np.asarray(boards).reshape(-1, 64)
+        return np.sum(b == Board.BLACK, axis=1)
+
 
 class ScorerWrapper(Scorer):
     def __init__(self, role, scorer):
@@ -186,3 +372,10 @@ class ScorerWrapper(Scorer):
             return val
         else:
             return -val
+
+    def evaluate_many(self, boards):
+        val = self._scorer.evaluate_many(boards)
+        if self._role == Board.BLACK:
+            return val
+        else:
+            return -val
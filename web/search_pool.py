@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import collections
+import multiprocessing as mp
+import os
+import threading
+import time
+
+from othello import Board
+from value import ModelScorer
+from ai import Bot, TranspositionTable
+from book import OpeningBook
+
+try:
+    import gevent
+
+    def _wait(result, timeout):
+        # block a hub thread instead of the event loop
+        return gevent.get_hub().threadpool.apply(result.get, (timeout,))
+except ImportError:
+    def _wait(result, timeout):
+        return result.get(timeout)
+
+# seconds of a search's deadline left to send its move back
+MARGIN = 0.2
+
+# nice increment of the ponder processes
+PONDER_NICENESS = 10
+
+
+_worker = None
+
+def _init_worker(model_file, book_file):
+    global _worker
+    scorer = ModelScorer(model_file)
+    book = OpeningBook(book_file) if book_file is not None else None
+    _worker = (Board(), scorer, TranspositionTable(), book)
+
+def _init_ponder_worker(model_file, book_file):
+    if hasattr(os, "nice"):
+        os.nice(PONDER_NICENESS)
+    _init_worker(model_file, book_file)
+
+def _search(cells, role, depth, final_depth, deadline):
+    board, scorer, table, book = _worker
+    board.set_board(cells)
+    time_limit = max(0.01, deadline - MARGIN - time.time())
+    bot = Bot(scorer, depth, final_depth, role, table, time_limit=time_limit, book=book,
+              collect_stats=True)
+    start = time.time()
+    move = bot.play(board)
+    return move, time.time() - start, bot.stats
+
+
+class SearchPool(object):
+    """Runs bot searches on a process pool so that they don't block the
+    server.
+
+    At most `max_queue` searches are queued or running, further requests
+    are refused (`search` returns None). A search has `deadline` seconds
+    from its request to answer, its midgame search deepens iteratively
+    up to `depth` within that time. A search that still has not answered
+    then (e.g. a slow endgame) is given up on, `search` returns None,
+    and it counts as pending until its worker is done. For every
+    `workers` searches already pending the depth and the endgame depth
+    are lowered by one and two.
+
+    `ponder` searches positions a game may reach next on a separate pool
+    of `ponder_workers` lower priority processes, a `search` of such a
+    position takes the pondered move. Ponder searches can't be cancelled,
+    but one that turns out useless then neither delays the searches
+    after it nor takes CPU time from them.
+    """
+    def __init__(self, model_file, book_file=None, workers=2, depth=4, final_depth=10,
+                 deadline=5.0, max_queue=None, ponder_workers=None):
+        self._workers = workers
+        if ponder_workers is None:
+            ponder_workers = workers
+        self._ponder_workers = ponder_workers
+        self._depth = depth
+        self._final_depth = final_depth
+        self._deadline = deadline
+        self._max_queue = max_queue or 4 * workers
+        self._pool = mp.Pool(workers, initializer=_init_worker, initargs=(model_file, book_file))
+        self._ponder_pool = None
+        if ponder_workers > 0:
+            self._ponder_pool = mp.Pool(ponder_workers, initializer=_init_ponder_worker,
+                                        initargs=(model_file, book_file))
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._latencies = collections.deque(maxlen=1000)
+        self.completed = 0
+        self.degraded = 0
+        self.refused = 0
+        self.timeouts = 0
+        # game id -> {(bits, role): pending result}
+        self._pondering = {}
+        self._ponder_running = 0
+        self.ponder_hits = 0
+        self.ponder_misses = 0
+        self.ponder_saved = 0.0
+
+    def _limits(self, waiting):
+        level = waiting // self._workers
+        return max(1, self._depth - level), max(0, self._final_depth - 2 * level)
+
+    def search(self, board, role, game_id=None):
+        """Returns the move of `role` on `board` and the `Bot.stats` of its
+        search, None if the queue is full or the deadline passed.
+        """
+        if game_id is not None:
+            with self._lock:
+                pondered = self._pondering.pop(game_id, {}).get((board.bits, role))
+                if pondered is None:
+                    self.ponder_misses += 1
+            if pondered is not None:
+                start = time.time()
+                try:
+                    move, elapsed, stats = _wait(pondered, self._deadline)
+                except mp.TimeoutError:
+                    with self._lock:
+                        self.timeouts += 1
+                    return None
+                waited = time.time() - start
+                with self._lock:
+                    self.completed += 1
+                    self.ponder_hits += 1
+                    self.ponder_saved += max(0.0, elapsed - waited)
+                    self._latencies.append(waited)
+                return move, dict(stats, pondered=True)
+
+        with self._lock:
+            if self._pending >= self._max_queue:
+                self.refused += 1
+                return None
+            depth, final_depth = self._limits(self._pending)
+            if depth < self._depth or final_depth < self._final_depth:
+                self.degraded += 1
+            self._pending += 1
+        start = time.time()
+        try:
+            result = self._pool.apply_async(_search, (board.board.tolist(), role, depth, final_depth,
+                                                      start + self._deadline),
+                                            callback=self._search_done, error_callback=self._search_done)
+        except Exception:
+            self._search_done(None)
+            raise
+        try:
+            move, _, stats = _wait(result, self._deadline)
+        except mp.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            return None
+        finally:
+            with self._lock:
+                self._latencies.append(time.time() - start)
+        with self._lock:
+            self.completed += 1
+        return move, stats
+
+    def _search_done(self, _):
+        with self._lock:
+            self._pending -= 1
+
+    def _ponder_done(self, _):
+        with self._lock:
+            self._ponder_running -= 1
+
+    def ponder(self, game_id, board, role):
+        """Starts searching the move of `role` on `board` for `game_id` if
+        a ponder worker is free, returns whether it did.
+        """
+        with self._lock:
+            if self._ponder_running >= self._ponder_workers:
+                return False
+            self._ponder_running += 1
+        result = self._ponder_pool.apply_async(_search, (board.board.tolist(), role, self._depth,
+                                                         self._final_depth, time.time() + self._deadline),
+                                               callback=self._ponder_done, error_callback=self._ponder_done)
+        with self._lock:
+            self._pondering.setdefault(game_id, {})[(board.bits, role)] = result
+        return True
+
+    def forget(self, game_id):
+        with self._lock:
+            self._pondering.pop(game_id, None)
+
+    def status(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            pending = self._pending
+        ret = { "workers": self._workers,
+                "ponderWorkers": self._ponder_workers,
+                "pending": pending,
+                "maxQueue": self._max_queue,
+                "completed": self.completed,
+                "degraded": self.degraded,
+                "refused": self.refused,
+                "timeouts": self.timeouts,
+                "ponderHits": self.ponder_hits,
+                "ponderMisses": self.ponder_misses,
+                "ponderSaved": self.ponder_saved }
+        if latencies:
+            ret["latencyMean"] = sum(latencies) / len(latencies)
+            ret["latencyP95"] = latencies[int(0.95 * (len(latencies) - 1))]
+            ret["latencyMax"] = latencies[-1]
+        return ret
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        if self._ponder_pool is not None:
+            # whatever is still pondered is of no use
+            self._ponder_pool.terminate()
+            self._ponder_pool.join()
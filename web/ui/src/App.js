@@ -111,7 +111,8 @@ class Board extends Component {
     var formData = new FormData();
     formData.append("data", JSON.stringify({
       steps: this.state.steps,
-      result: (this.state.blackScore - this.state.whiteScore)
+      result: (this.state.blackScore - this.state.whiteScore),
+      gameId: this.state.gameId
     }));
     fetch("/othello/report", {
       method: "post",
@@ -4,20 +4,85 @@ import sys
 sys.path.append("../")
 
 import os
+import collections
+import multiprocessing as mp
+import threading
+import time
+
+try:
+    from gevent.lock import Semaphore as GameLock
+except ImportError:
+    GameLock = threading.Lock
 
 from flask import Flask, request, send_from_directory, jsonify
 import json
 from othello import Board
 from value import ModelScorer, ScorerWrapper
-from ai import Bot
+from ai import Bot, TranspositionTable
+from book import OpeningBook
+from util import Config
+from search_pool import SearchPool
 
-board = Board()
 model_file = "../model/model.cpt.npy"
+book_file = "../model/book.npy"
+if not os.path.exists(book_file):
+    book_file = None
+
+# the [Web] section of the player config sets the bot's seconds per
+# move and its midgame and endgame depths
+config = Config("../config/config.ini")
+
+# a move is played right away with a depth 1 search (or from the book)
+# when the search queue is full. The feature cache and the evaluation
+# count of the model and the transposition table are changed by every
+# search, so they are only used under model_lock, which is never held
+# across a yield. Loading the model and the book here also fails fast
+# on a bad file, before pool workers keep dying on it
+model_lock = threading.Lock()
 scorer = ModelScorer(model_file)
-black_bot = Bot(scorer, 4, 10, Board.BLACK)
-white_bot = Bot(scorer, 4, 10, Board.WHITE)
-
-role_mapping = { "black": (black_bot, Board.BLACK), "white": (white_bot, Board.WHITE) }
+book = OpeningBook(book_file) if book_file is not None else None
+table = TranspositionTable()
+fallback_bots = { Board.BLACK: Bot(scorer, 1, 0, Board.BLACK, table, book=book),
+                  Board.WHITE: Bot(scorer, 1, 0, Board.WHITE, table, book=book) }
+
+# searches run on worker processes, each with its own model and
+# transposition table
+search_pool = SearchPool(model_file, book_file, workers=max(1, mp.cpu_count() - 1),
+                         depth=config.get_as_int("Web", "depth", 4),
+                         final_depth=config.get_as_int("Web", "final_depth", 10),
+                         deadline=config.get_as_float("Web", "time", 5.0))
+
+roles = { "black": Board.BLACK, "white": Board.WHITE }
+
+# after a bot move, the bot's answers to this many of the human's most
+# likely replies are searched while the human thinks
+PONDER_WIDTH = 3
+
+class Session(object):
+    """Board of one game, requests of a game are serialized by its lock.
+    A search yields to the event loop while the lock is held, so under
+    gevent it is a gevent lock, which a waiting request yields on too.
+    """
+    def __init__(self):
+        self.lock = GameLock()
+        self.board = Board()
+
+MAX_SESSIONS = 1000
+sessions = collections.OrderedDict()
+sessions_lock = threading.Lock()
+
+def _session(game_id):
+    """The session of `game_id`, the least recently used session is
+    dropped when there are more than MAX_SESSIONS.
+    """
+    with sessions_lock:
+        s = sessions.pop(game_id, None)
+        if s is None:
+            s = Session()
+            if len(sessions) >= MAX_SESSIONS:
+                search_pool.forget(sessions.popitem(last=False)[0])
+        sessions[game_id] = s
+        return s
 
 def _opponent(role):
     if role == Board.BLACK:
@@ -33,7 +98,7 @@ def index():
 
 @app.route("/othello/new")
 def new_game():
-    board.init_board()
+    board = Board()
     ret = { "board": board.board.tolist(),
             "options": board.feasible_pos(Board.BLACK),
             "blackScore": 2,
@@ -45,14 +110,29 @@ def new_game():
 def play():
     data = json.loads(request.form["data"])
 
-    player, role = role_mapping[data["player"]]
+    session = _session(data["gameId"])
+    with session.lock:
+        return _play(session, data)
+
+def _play(session, data):
+    board = session.board
+    role = roles[data["player"]]
 
     board.set_board(data["board"])
 
     if "action" in data:
         r, c = data["action"]
     else:
-        r, c = player.play(board)
+        start = time.time()
+        found = search_pool.search(board, role, data["gameId"])
+        if found is None:
+            app.logger.warning("{} search queue full or too slow, playing depth 1".format(data["gameId"]))
+            with model_lock:
+                found = fallback_bots[role].play(board), {"source": "fallback"}
+        (r, c), stats = found
+        app.logger.info("{} search {:.3f}s {}".format(data["gameId"], time.time() - start,
+                                                      search_pool.status()))
+        app.logger.info("{} stats {}".format(data["gameId"], json.dumps(stats)))
 
     app.logger.info("{} {} ({},{}) {}".format(data["gameId"],
                                               data["player"],
@@ -69,6 +149,9 @@ def play():
     if len(options) == 0:
         next_role_name = "none"
 
+    if PONDER_WIDTH > 0 and "action" not in data and next_role != role:
+        _ponder(data["gameId"], board, next_role, role, options)
+
     black_score = board.score(Board.BLACK)
     white_score = board.score(Board.WHITE)
     ret = { "action": [r, c],
@@ -80,9 +163,32 @@ def play():
 
     return jsonify(**ret)
 
+def _ponder(game_id, board, human, bot, options):
+    """Ponders the bot's answers to the human's best replies by the
+    model.
+    """
+    sign = 1 if human == Board.BLACK else -1
+    values = []
+    with model_lock:
+        for i, j in options:
+            with board.flip2(i, j, human):
+                values.append((sign * scorer(board), (i, j)))
+    values.sort(reverse=True)
+    for _, (i, j) in values[:PONDER_WIDTH]:
+        with board.flip2(i, j, human):
+            if board.feasible_pos(bot) and not search_pool.ponder(game_id, board, bot):
+                break
+
+@app.route("/othello/status")
+def status():
+    return jsonify(**search_pool.status())
+
 @app.route("/othello/report", methods=["POST"])
 def report():
     data = json.loads(request.form["data"])
+    with sessions_lock:
+        sessions.pop(data.get("gameId"), None)
+    search_pool.forget(data.get("gameId"))
     moves = []
     for step in data["steps"]:
         player = step["player"]